@@ -4,7 +4,6 @@
 :Date: 03.08.2017
 """
 
-import re
 from copy import deepcopy
 from typing import Callable, Optional, Type
 
@@ -14,19 +13,35 @@ from pyramid.config import Configurator
 from pyramid.registry import Registry
 
 from .interfaces import ICeleryQueuesFactory
-from .utils import TaskProxy, get_celery
+from .manifest import SCAN_CATEGORY, scan_celery_tasks
+from .outbox import TasksOutbox, get_tasks_outbox
+from .stats import AggregatingStatsSink, StatsSink, set_celery_stats_sink
+from .utils import TaskProxy, add_task_action, apply_many, get_celery
+
+
+__all__ = [
+    'AggregatingStatsSink',
+    'StatsSink',
+    'TaskProxy',
+    'TasksOutbox',
+    'add_celery_queues_factory',
+    'add_celery_tasks_alt_name_factory',
+    'apply_many',
+    'get_celery',
+    'includeme',
+    'scan_celery_tasks',
+    'set_celery_config',
+    'set_celery_stats_sink',
+    'task',
+]
 
 
 def includeme(config: Configurator):
     config.add_directive('add_celery_queues_factory', add_celery_queues_factory)
     config.add_directive('set_celery_config', set_celery_config)
-    ignore = [
-        re.compile('tests$').search,
-        re.compile('testing$').search,
-        re.compile('docs$').search,
-        re.compile('conftest$').search,
-    ]
-    config.scan(ignore=ignore)
+    config.add_directive('scan_celery_tasks', scan_celery_tasks)
+    config.add_directive('set_celery_stats_sink', set_celery_stats_sink)
+    config.add_request_method(get_tasks_outbox, 'pcelery_outbox', reify=True)
 
 
 def add_celery_queues_factory(
@@ -60,30 +75,28 @@ def task(**kwargs):
     run on the module, not during import time.
     Otherwise we mimic the behavior of :py:meth:`celery.Celery.task`.
 
+    :param propagate_request: if it is ``False``, HTTP request is not embedded
+        into messages of this task and task receives blank Pyramid request.
     :param kwargs: Passed to Celery task decorator
     """
+    propagate_request = kwargs.pop('propagate_request', True)
 
     def _inner(func):
-        proxy = TaskProxy(func)
+        proxy = TaskProxy(
+            func, task_options=kwargs, propagate_request=propagate_request
+        )
 
         def callback(scanner, name, task_proxy):
-            config = scanner.config
-
-            def register():
-                registry = config.registry
-                celery = get_celery(registry)
-                celery_task = celery.task(task_proxy.original_func, **kwargs)
-                if alt_name_factories := config.registry.get(
-                    'pcelery_alt_name_factories', None
-                ):
-                    for alt_name_factory in alt_name_factories:
-                        if alt_name := alt_name_factory(celery_task):
-                            celery.tasks[alt_name] = celery_task
-                proxy.bind_celery_task(celery_task)
-
-            config.action('bind_celery_task - %s' % name, register)
+            add_task_action(scanner.config, name, task_proxy)
+
+        def collect_callback(scanner, name, task_proxy):
+            # Collect found tasks if it is requested by scan_celery_tasks()
+            scanned_tasks = getattr(scanner, 'pcelery_tasks', None)
+            if scanned_tasks is not None:
+                scanned_tasks.append((name, task_proxy))
 
         venusian.attach(proxy, callback, category='pyramid')
+        venusian.attach(proxy, collect_callback, category=SCAN_CATEGORY)
         return proxy
 
     return _inner
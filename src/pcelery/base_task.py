@@ -4,22 +4,46 @@
 :Date: 14.11.2016
 """
 
-from typing import Optional
+import io
+import json
+import threading
+from collections import Counter, deque
+from copy import copy
+from functools import lru_cache
+from time import perf_counter
+from typing import Callable, Iterable, Optional
 
 from celery import Task as BaseTask
 from celery.app import pop_current_task, push_current_task
 from celery.signals import before_task_publish
-from pyramid.interfaces import IRequestFactory, IRootFactory
+from pyramid.decorator import reify
+from pyramid.interfaces import IRequestExtensions, IRequestFactory, IRootFactory
 from pyramid.registry import Registry
 from pyramid.request import Request, apply_request_extensions
-from pyramid.threadlocal import RequestContext, get_current_request
+from pyramid.threadlocal import get_current_registry, get_current_request, manager
 from pyramid.traversal import DefaultRootFactory
 
+from .stats import STATS_SINK_KEY, StatsSink, get_stats_sink
+
 
 EXTRA_PARAMS_NAME = 'pcelery.extra'
+EXTRA_CACHE_ATTR = '_pcelery_extra'
+ENV_FILTER_KEY = 'pcelery_request_env_filter'
+REQUEST_BUILDER_KEY = 'pcelery_request_builder'
+REQUEST_PROPAGATION_KEY = 'pcelery_request_propagation'
+
+_publish_local = threading.local()
+_reused_requests = threading.local()
+# Max number of reused Pyramid requests kept by one thread
+REUSED_REQUESTS_LIMIT = 32
 
 
 class PyramidCeleryTask(BaseTask):
+    #: Reuse Pyramid request (and its root) of the previous task executed
+    #: in the same thread if both messages contain the same HTTP request.
+    #: Attributes set on the request by the previous task are dropped.
+    reuse_pyramid_request = False
+
     def _call_directly(self, *args, **kwargs):
         # Emulate BaseTask.__call__()
         push_current_task(self)
@@ -42,13 +66,44 @@ class PyramidCeleryTask(BaseTask):
         # This method in BaseTask called only if a task called directly.
         # Celery do not run this method if it is not customized in the sub-class.
         # So we not need to emulate base version of this method if it is not called directly.
-        context = RequestContext(self.pyramid_request)
-        context.begin()
+        sink = get_stats_sink(self.pyramid_registry)
+        if sink is not None:
+            return self._timed_call(sink, args, kwargs)
+
+        task_request = self.request
+        manager.push(LazyRequestInfo(self, task_request))
         try:
             return self._wrapped_run(*args, **kwargs)
         finally:
-            context.request._process_finished_callbacks()
-            context.end()
+            request = getattr(task_request, 'pyramid_request', None)
+            if request is not None:
+                request._process_finished_callbacks()
+            manager.pop()
+
+    def _timed_call(self, sink: StatsSink, args, kwargs):
+        """Version of __call__() that measures durations of execution phases."""
+        tags = {'task': self.name}
+        task_request = self.request
+        start = perf_counter()
+        manager.push(LazyRequestInfo(self, task_request))
+        sink.observe('pcelery.task.context_begin', perf_counter() - start, tags)
+        try:
+            start = perf_counter()
+            try:
+                return self._wrapped_run(*args, **kwargs)
+            finally:
+                sink.observe('pcelery.task.run', perf_counter() - start, tags)
+        finally:
+            request = getattr(task_request, 'pyramid_request', None)
+            if request is not None:
+                start = perf_counter()
+                request._process_finished_callbacks()
+                sink.observe(
+                    'pcelery.task.finished_callbacks', perf_counter() - start, tags
+                )
+            start = perf_counter()
+            manager.pop()
+            sink.observe('pcelery.task.context_end', perf_counter() - start, tags)
 
     def _wrapped_run(self, *args, **kwargs):
         """This method may be overridden in child class"""
@@ -62,18 +117,149 @@ class PyramidCeleryTask(BaseTask):
 
     @property
     def pyramid_request(self) -> Request:
-        request = getattr(self.request, 'pyramid_request', None)
+        return self._get_pyramid_request(self.request)
+
+    def _get_pyramid_request(self, task_request) -> Request:
+        request = getattr(task_request, 'pyramid_request', None)
+        if request and hasattr(request, 'root'):
+            return request
+        registry = self.pyramid_registry
+        sink = get_stats_sink(registry)
+        start = perf_counter() if sink is not None else 0
+        extra = None
         if not request:
-            extra = getattr(self.request, EXTRA_PARAMS_NAME, {})
+            extra = getattr(task_request, EXTRA_PARAMS_NAME, {})
+            if self.reuse_pyramid_request:
+                request = self._get_reused_request(extra)
+                if request is not None:
+                    task_request.pyramid_request = request
+                    if sink is not None:
+                        sink.incr('pcelery.task.reused_request', {'task': self.name})
+                    return request
             data = extra.get('http_request', None)
-            request = deserialize_request(data, self.pyramid_registry)
-            self.request.pyramid_request = request
+            request = deserialize_request(data, registry)
+            task_request.pyramid_request = request
+            if sink is not None:
+                now = perf_counter()
+                sink.observe(
+                    'pcelery.task.deserialize_request', now - start, {'task': self.name}
+                )
+                start = now
         if not hasattr(request, 'root'):
             # It is not real worker, most likely it is testing environment
-            root_factory = self.pyramid_registry.queryUtility(
-                IRootFactory, default=DefaultRootFactory
-            )
+            root_factory = get_request_builder(registry).root_factory
             request.root = root_factory(request)
+            if sink is not None:
+                sink.observe(
+                    'pcelery.task.root_factory',
+                    perf_counter() - start,
+                    {'task': self.name},
+                )
+        if extra is not None and self.reuse_pyramid_request:
+            cache = _get_reused_requests_cache()
+            key = (id(registry), self.name)
+            cache.pop(key, None)
+            if len(cache) >= REUSED_REQUESTS_LIMIT:
+                # Drop the least recently created request
+                del cache[next(iter(cache))]
+            cache[key] = ReusedRequest(extra, request)
+        return request
+
+    def _get_reused_request(self, extra: dict) -> Optional[Request]:
+        """Returns Pyramid request created for the previous task in the current
+        thread if it has been published from the same HTTP request
+        and belongs to the registry of the task."""
+        registry = self.pyramid_registry
+        cache = _get_reused_requests_cache()
+        reused: Optional[ReusedRequest] = cache.get((id(registry), self.name))
+        if (
+            reused is not None
+            and reused.request.registry is registry
+            and (reused.extra is extra or reused.extra == extra)
+        ):
+            return reused.reset()
+
+
+def _get_reused_requests_cache() -> dict:
+    """Returns requests of tasks of the current thread keyed
+    by id of registry and name of task."""
+    cache = getattr(_reused_requests, 'cache', None)
+    if cache is None:
+        cache = _reused_requests.cache = {}
+    return cache
+
+
+class ReusedRequest:
+    """Pyramid request of a task with its state right after creation.
+
+    Values of reified properties (except containers) are not kept,
+    they are computed again by the next task. Containers (e.g. callbacks)
+    are copied on every reset, so changes made by a task don't leak
+    into the next one.
+    """
+
+    __slots__ = ('extra', 'request', 'state', 'environ')
+
+    def __init__(self, extra: dict, request: Request):
+        self.extra = extra
+        self.request = request
+        cls = type(request)
+        self.state = _copy_containers(
+            {
+                name: value
+                for name, value in request.__dict__.items()
+                if type(value) in _CONTAINER_TYPES
+                or not isinstance(getattr(cls, name, None), reify)
+            }
+        )
+        self.environ = dict(request.environ)
+
+    def reset(self) -> Request:
+        """Restore the initial state of the request and returns it."""
+        request = self.request
+        state = request.__dict__
+        state.clear()
+        state.update(_copy_containers(self.state))
+        environ = request.environ
+        environ.clear()
+        environ.update(self.environ)
+        environ['wsgi.input'] = io.BytesIO()
+        return request
+
+
+_CONTAINER_TYPES = (deque, list, dict, set)
+
+
+def _copy_containers(state: dict) -> dict:
+    """Returns copy of the state of request with copied containers,
+    except environ that is restored separately."""
+    return {
+        name: (
+            copy(value)
+            if name != 'environ' and type(value) in _CONTAINER_TYPES
+            else value
+        )
+        for name, value in state.items()
+    }
+
+
+class LazyRequestInfo(dict):
+    """Thread local info of Pyramid that creates a request on first access.
+
+    It is pushed instead of ``RequestContext`` while a task is executed
+    by worker. So Pyramid request is not deserialized if neither task
+    nor ``get_current_request()`` use it.
+    """
+
+    def __init__(self, task: PyramidCeleryTask, task_request):
+        super().__init__(registry=task.pyramid_registry)
+        self.task = task
+        self.task_request = task_request
+
+    def __missing__(self, key):
+        if key != 'request':
+            raise KeyError(key)
+        request = self['request'] = self.task._get_pyramid_request(self.task_request)
         return request
 
 
@@ -81,16 +267,254 @@ class PyramidCeleryTask(BaseTask):
 def add_params_to_task(sender=None, body=None, **kwargs):
     if isinstance(body, tuple):
         # http://docs.celeryproject.org/en/latest/internals/protocol.html#definition
-        embed = body[2]
-        request = get_current_request()
-        extra = {
-            'http_request': serialize_request(request),
-        }
-        embed[EXTRA_PARAMS_NAME] = extra
+        registry = get_current_registry()
+        sink = registry.get(STATS_SINK_KEY)
+        if sink is None:
+            _add_params_to_task(registry, sender, body)
+        else:
+            _timed_add_params_to_task(sink, registry, sender, body, kwargs)
+
+
+def _add_params_to_task(
+    registry: Registry, task_name: str, body: tuple
+) -> Optional[dict]:
+    """Embeds extra params into the message body if request propagation
+    is enabled for the task. Returns the embedded params."""
+    propagation = registry.get(REQUEST_PROPAGATION_KEY)
+    if propagation and not propagation.get(task_name, True):
+        return None
+    extra = body[2][EXTRA_PARAMS_NAME] = _get_publish_extra()[1]
+    return extra
+
+
+def _timed_add_params_to_task(
+    sink: StatsSink,
+    registry: Registry,
+    task_name: str,
+    body: tuple,
+    kwargs: dict,
+):
+    """Version of add_params_to_task() that sends metrics into the sink."""
+    start = perf_counter()
+    extra = _add_params_to_task(registry, task_name, body)
+    duration = perf_counter() - start
+
+    request = _get_publish_request()
+    route = get_route_name(request)
+    tags = {'task': task_name, 'route': route}
+    sink.observe('pcelery.publish.add_params', duration, tags)
+    if extra is not None:
+        sink.observe(
+            'pcelery.publish.envelope_size', _get_extra_size(request, extra), tags
+        )
+    tags = {'task': task_name, 'route': route, 'queue': _get_queue_name(kwargs)}
+    sink.incr('pcelery.publish.messages', tags)
+
+
+def _get_queue_name(publish_kwargs: dict) -> str:
+    """Returns name of the queue of a message from arguments
+    of ``before_task_publish`` signal or empty string."""
+    declare = publish_kwargs.get('declare')
+    if declare:
+        return declare[0].name
+    if publish_kwargs.get('exchange') == '':
+        # Direct messages are sent through the anonymous exchange
+        # with the name of queue as routing key.
+        return publish_kwargs.get('routing_key') or ''
+    return ''
 
 
-def serialize_request(request: Request) -> dict:
-    env = {key: value for key, value in request.environ.items() if key.isupper()}
+def _get_publish_request() -> Optional[Request]:
+    """Returns the request of a message that is published now
+    in the current thread."""
+    captured = getattr(_publish_local, 'captured', None)
+    if captured is not None:
+        return captured.request
+    return get_current_request()
+
+
+def _get_publish_extra() -> tuple:
+    """Returns the request and extra params for a message that
+    is published now in the current thread."""
+    captured = getattr(_publish_local, 'captured', None)
+    if captured is not None and captured.extra is not None:
+        return captured.request, captured.extra
+    request = get_current_request()
+    return request, get_request_extra(request)
+
+
+class CapturedRequest:
+    """Current (or given) registry, request and extra params of task
+    messages captured in one thread to publish tasks in another one.
+
+    Extra params are computed at the moment of creation of this object,
+    so later changes of the request don't affect published messages.
+    Use the instance as a context manager in the publishing thread.
+    """
+
+    __slots__ = ('registry', 'request', 'extra')
+
+    def __init__(
+        self, task_name: Optional[str] = None, request: Optional[Request] = None
+    ):
+        if request is None:
+            self.registry = get_current_registry()
+            self.request = get_current_request()
+        else:
+            self.registry = request.registry
+            self.request = request
+        self.extra = None
+        propagation = self.registry.get(REQUEST_PROPAGATION_KEY)
+        if propagation and not propagation.get(task_name, True):
+            return
+        if self.request is not None:
+            self.extra = get_request_extra(self.request)
+
+    def __enter__(self):
+        manager.push({'registry': self.registry, 'request': self.request})
+        _publish_local.captured = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _publish_local.captured = None
+        manager.pop()
+
+
+def get_route_name(request: Optional[Request]) -> str:
+    """Returns name of matched route of the request or empty string."""
+    route = getattr(request, 'matched_route', None)
+    return route.name if route is not None else ''
+
+
+def _get_extra_size(request: Optional[Request], extra: dict) -> int:
+    """Returns size of extra params serialized into JSON.
+
+    The size is cached on the request with cached extra params.
+    """
+    cached = getattr(request, EXTRA_CACHE_ATTR, None)
+    if cached is None or cached[1] is not extra:
+        return len(json.dumps(extra, default=str))
+    fingerprint, extra, *size = cached
+    if size:
+        return size[0]
+    size = len(json.dumps(extra, default=str))
+    setattr(request, EXTRA_CACHE_ATTR, (fingerprint, extra, size))
+    return size
+
+
+def get_request_extra(request: Request) -> dict:
+    """Returns extra params that will be embedded into a task message.
+
+    The result is cached on the given request, so all tasks published
+    during one HTTP request share the same object. The cache is dropped
+    if any item of the request environ has been changed.
+    """
+    environ = request.environ
+    cached = getattr(request, EXTRA_CACHE_ATTR, None)
+    if cached and cached[0] == environ:
+        return cached[1]
+    # Shallow copy of environ is compared with the current one on each call
+    fingerprint = dict(environ)
+    registry = getattr(request, 'registry', None)
+    env_filter = None
+    sink = None
+    if registry is not None:
+        env_filter = registry.get(ENV_FILTER_KEY)
+        sink = registry.get(STATS_SINK_KEY)
+    start = perf_counter() if sink is not None else 0
+    dropped = [] if sink is not None else None
+    extra = {
+        'http_request': serialize_request(request, env_filter, dropped),
+    }
+    if sink is not None:
+        route = get_route_name(request)
+        sink.observe(
+            'pcelery.publish.serialize_request',
+            perf_counter() - start,
+            {'route': route},
+        )
+        for key in dropped:
+            sink.incr('pcelery.publish.env_dropped', {'route': route, 'key': key})
+    setattr(request, EXTRA_CACHE_ATTR, (fingerprint, extra))
+    return extra
+
+
+class RequestEnvFilter:
+    """Selects items of WSGI environ that will be embedded into task messages.
+
+    :param allow: if given, only these environ keys will be embedded.
+    :param deny: environ keys that will never be embedded.
+    :param predicate: callable ``(key, value) -> bool``, returns ``False``
+        for items that must be skipped.
+    :param max_value_size: items which size (length of key and value)
+        exceeds this limit are dropped.
+    :param max_size: total size of embedded environ; items that do not fit
+        into this budget are dropped.
+
+    Number of dropped items is counted by environ key in ``dropped``
+    and is sent into the sink of metrics (``pcelery.publish.env_dropped``).
+    """
+
+    def __init__(
+        self,
+        allow: Optional[Iterable[str]] = None,
+        deny: Optional[Iterable[str]] = None,
+        predicate: Optional[Callable[[str, object], bool]] = None,
+        max_value_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+    ):
+        self.allow = frozenset(allow) if allow is not None else None
+        self.deny = frozenset(deny or ())
+        self.predicate = predicate
+        self.max_value_size = max_value_size
+        self.max_size = max_size
+        self.dropped = Counter()
+
+    def __call__(self, environ: dict, dropped: Optional[list] = None) -> dict:
+        """Returns selected items of the environ. Keys of items dropped
+        by size limits are appended into ``dropped`` if it is given."""
+        allow = self.allow
+        deny = self.deny
+        predicate = self.predicate
+        max_value_size = self.max_value_size
+        max_size = self.max_size
+        check_size = max_value_size is not None or max_size is not None
+        env = {}
+        size = 0
+        for key, value in environ.items():
+            if not key.isupper():
+                continue
+            if allow is not None and key not in allow:
+                continue
+            if key in deny:
+                continue
+            if predicate is not None and not predicate(key, value):
+                continue
+            if check_size:
+                item_size = len(key) + len(
+                    value if isinstance(value, str) else str(value)
+                )
+                if (max_value_size is not None and item_size > max_value_size) or (
+                    max_size is not None and size + item_size > max_size
+                ):
+                    self.dropped[key] += 1
+                    if dropped is not None:
+                        dropped.append(key)
+                    continue
+                size += item_size
+            env[key] = value
+        return env
+
+
+def serialize_request(
+    request: Request,
+    env_filter: Optional[RequestEnvFilter] = None,
+    dropped: Optional[list] = None,
+) -> dict:
+    if env_filter is None:
+        env = {key: value for key, value in request.environ.items() if key.isupper()}
+    else:
+        env = env_filter(request.environ, dropped)
     if 'CONTENT_LENGTH' in env:
         env['CONTENT_LENGTH'] = '0'
     data = {
@@ -105,14 +529,56 @@ def deserialize_request(
     registry: Registry,
     default_url='http://localhost',
 ) -> Request:
-    if data:
-        url = data['REQUEST_URL']
-        env = data['REQUEST_ENV']
-    else:
-        url = default_url
-        env = None
-    request_factory = registry.queryUtility(IRequestFactory, default=Request)
-    request = request_factory.blank(url, env)
-    request.registry = registry
-    apply_request_extensions(request)
-    return request
+    return get_request_builder(registry).create_request(data, default_url)
+
+
+class RequestBuilder:
+    """Creates Pyramid requests from serialized data on worker side.
+
+    Request factory, root factory and request extensions are resolved
+    once. Environs prepared by ``request_factory.blank()`` are cached
+    by serialized data, so a new request is created from a copy
+    of cached environ.
+    """
+
+    def __init__(self, registry: Registry, cache_size=128):
+        self.registry = registry
+        self.request_factory = registry.queryUtility(IRequestFactory, default=Request)
+        self.root_factory = registry.queryUtility(
+            IRootFactory, default=DefaultRootFactory
+        )
+        self.extensions = registry.queryUtility(IRequestExtensions)
+        self._get_environ_template = lru_cache(maxsize=cache_size)(
+            self._create_environ_template
+        )
+
+    def _create_environ_template(self, url: str, env_items: tuple) -> dict:
+        env = dict(env_items) if env_items else None
+        return self.request_factory.blank(url, env).environ
+
+    def create_request(self, data: Optional[dict], default_url: str) -> Request:
+        if data:
+            url = data['REQUEST_URL']
+            env = data['REQUEST_ENV']
+        else:
+            url = default_url
+            env = None
+        try:
+            env_items = tuple(env.items()) if env else ()
+            template = self._get_environ_template(url, env_items)
+        except TypeError:
+            # Environ contains unhashable values
+            template = self._create_environ_template(url, env)
+        environ = dict(template)
+        environ['wsgi.input'] = io.BytesIO()
+        request = self.request_factory(environ)
+        request.registry = self.registry
+        apply_request_extensions(request, extensions=self.extensions)
+        return request
+
+
+def get_request_builder(registry: Registry) -> RequestBuilder:
+    builder = registry.get(REQUEST_BUILDER_KEY)
+    if builder is None:
+        builder = registry[REQUEST_BUILDER_KEY] = RequestBuilder(registry)
+    return builder
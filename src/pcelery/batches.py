@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+
+Batched execution of tasks by worker.
+
+Messages of a task decorated with ``@task(batch_size=N, batch_timeout=S)``
+are buffered by worker, and the task function is called once with list
+of ``BatchItem`` when the buffer contains ``N`` messages or after ``S``
+seconds since the first buffered message. All items of a batch share one
+Pyramid request built from the HTTP request of the first message.
+
+A batch is executed by the tracer of the task as one task with id
+of the first message: signals of the task are sent and the result
+(or the state) is stored in the result backend once per batch and only
+under this id. Arguments of a batch are not serializable, so ``retry()``
+and ``result_extended`` are not supported. A raised ``Reject`` rejects
+all messages of the batch.
+"""
+
+import threading
+from typing import Optional
+
+from celery import Celery, current_app, states
+from celery.app.task import Task
+from celery.app.trace import trace_task
+from celery.utils.imports import symbol_by_name
+
+from .base_task import EXTRA_PARAMS_NAME
+
+
+BATCH_REQUEST_ATTR = 'pcelery_batch'
+DEFAULT_BATCH_TIMEOUT = 1.0
+# States of batch after which messages are acknowledged with ``acks_late``
+ACKED_STATES = frozenset((states.RETRY, states.IGNORED))
+
+
+class BatchItem:
+    """One message of a batch."""
+
+    __slots__ = ('id', 'args', 'kwargs', 'delivery_info', 'extra')
+
+    def __init__(self, id, args, kwargs, delivery_info=None, extra=None):
+        self.id = id
+        self.args = args
+        self.kwargs = kwargs
+        self.delivery_info = delivery_info
+        self.extra = extra
+
+    def __repr__(self):
+        return f'BatchItem({self.id!r}, {self.args!r}, {self.kwargs!r})'
+
+
+class BatchTaskMixin:
+    """Mixin of task classes that are executed by batches.
+
+    If a task is executed not by batch strategy (directly or by
+    ``TasksQueue``), the task function receives a batch with one item.
+    """
+
+    Strategy = 'pcelery.batches:batch_strategy'
+    batch_size: int = 1
+    batch_timeout: float = DEFAULT_BATCH_TIMEOUT
+
+    def __call__(self, *args, **kwargs):
+        task_request = self.request
+        if not getattr(task_request, BATCH_REQUEST_ATTR, False):
+            item = BatchItem(task_request.id, args, kwargs)
+            args, kwargs = ([item],), {}
+        return super().__call__(*args, **kwargs)
+
+
+def get_batch_task_class(celery: Celery, base: type) -> type:
+    """Returns subclass of the given task class that is executed by batches.
+
+    Subclasses are cached on the Celery app, so they are released with it.
+    """
+    classes = getattr(celery, 'pcelery_batch_task_classes', None)
+    if classes is None:
+        classes = celery.pcelery_batch_task_classes = {}
+    task_class = classes.get(base)
+    if task_class is None:
+        task_class = classes[base] = type(
+            'Batch' + base.__name__, (BatchTaskMixin, base), {}
+        )
+    return task_class
+
+
+def execute_batch(task_name: str, items: list) -> Optional[tuple[str, bool]]:
+    """Execute the batch inside of a pool process by the tracer of the task.
+
+    Returns ``None`` if the task has succeeded, otherwise a tuple
+    of the state of the task (``FAILURE``, ``RETRY``, ``REJECTED``
+    or ``IGNORED``) and the flag of requeue of rejected messages.
+    """
+    app = current_app
+    task: Task = app.tasks[task_name]
+    first = items[0]
+    request = {
+        'delivery_info': first.delivery_info,
+        BATCH_REQUEST_ATTR: True,
+    }
+    if first.extra is not None:
+        request[EXTRA_PARAMS_NAME] = first.extra
+    _, info, *_ = trace_task(task, first.id, (items,), {}, request, app=app)
+    if info is None:
+        return None
+    requeue = info.state == states.REJECTED and getattr(info.retval, 'requeue', False)
+    return info.state, bool(requeue)
+
+
+def batch_strategy(task, app, consumer, **kwargs):
+    """Worker strategy that buffers messages of the task and executes
+    them by batches in the pool.
+
+    Messages are acknowledged individually: before execution of the batch,
+    or after it if the task has ``acks_late``. Messages of a failed
+    or rejected batch are rejected if the task has ``acks_late``.
+    ETA and rate limits of messages are not supported.
+    """
+    Request = symbol_by_name(task.Request)
+    revoked_tasks = consumer.controller.state.revoked
+    timer = consumer.timer
+    qos = consumer.qos
+    pool = consumer.pool
+    batch_size = task.batch_size
+    batch_timeout = task.batch_timeout
+    lock = threading.Lock()
+    buffer = []
+    timer_entry = None
+
+    def take_buffer() -> list:
+        nonlocal timer_entry
+        if timer_entry is not None:
+            timer_entry.cancel()
+            timer_entry = None
+        requests = buffer[:]
+        buffer.clear()
+        return requests
+
+    def on_timeout():
+        with lock:
+            requests = take_buffer()
+        flush(requests)
+
+    def flush(requests: list):
+        if not requests:
+            return
+        items = []
+        for req in requests:
+            # Decoded body is cached by the message
+            embed = req.message.payload[2] or {}
+            items.append(
+                BatchItem(
+                    req.id,
+                    req.args,
+                    req.kwargs,
+                    req.delivery_info,
+                    embed.get(EXTRA_PARAMS_NAME),
+                )
+            )
+            if not task.acks_late:
+                req.acknowledge()
+
+        def on_return(result):
+            for req in requests:
+                if task.acks_late:
+                    if result is None or result[0] in ACKED_STATES:
+                        req.acknowledge()
+                    else:
+                        req.reject(requeue=result[1])
+                qos.decrement_eventually()
+
+        def on_error(exc):
+            on_return((states.FAILURE, False))
+
+        pool.apply_async(
+            execute_batch,
+            args=(task.name, items),
+            callback=on_return,
+            error_callback=on_error,
+        )
+
+    def task_message_handler(message, body, ack, reject, callbacks, **kw):
+        nonlocal timer_entry
+        req = Request(
+            message,
+            on_ack=ack,
+            on_reject=reject,
+            app=app,
+            hostname=consumer.hostname,
+            task=task,
+            connection_errors=consumer.connection_errors,
+            body=message.body,
+            headers=message.headers,
+            decoded=False,
+            utc=app.uses_utc_timezone(),
+        )
+        if (req.expires or req.id in revoked_tasks) and req.revoked():
+            return
+        # Allow to prefetch more messages while they are buffered
+        qos.increment_eventually()
+        requests = None
+        with lock:
+            buffer.append(req)
+            if len(buffer) >= batch_size:
+                requests = take_buffer()
+            elif timer_entry is None:
+                timer_entry = timer.call_after(batch_timeout, on_timeout)
+        if requests:
+            flush(requests)
+
+    return task_message_handler
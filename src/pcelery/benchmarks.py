@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+
+Benchmarks of hot paths of pcelery.
+
+All benchmarks run offline with ``memory://`` transport. Results are printed
+(or written into a file) as JSON, so they may be compared between versions
+of pcelery, Celery and Pyramid:
+
+    pcelery_benchmark --output results.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+from importlib.metadata import PackageNotFoundError, version
+from types import SimpleNamespace
+
+from celery import Celery
+from kombu import Exchange, Queue
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.threadlocal import RequestContext
+
+from . import task
+from .base_task import deserialize_request, get_request_extra, serialize_request
+from .routers import RouterByRoutingKey
+from .testing import TasksQueue
+from .utils import get_celery
+
+
+ENV_SIZES = (10, 100, 1000)
+
+
+@task()
+def benchmark_task(value=None):
+    return value
+
+
+def create_request(env_size: int = 10) -> Request:
+    request = Request.blank('http://localhost/path?query=1')
+    for i in range(env_size):
+        request.environ[f'HTTP_X_HEADER_{i}'] = f'value {i}' * 4
+    return request
+
+
+def measure(name: str, func, number: int, repeat: int, **params) -> dict:
+    times = timeit.repeat(func, number=number, repeat=repeat)
+    best = min(times)
+    return {
+        'name': name,
+        'params': params,
+        'number': number,
+        'repeat': repeat,
+        'best_seconds': best,
+        'us_per_op': best / number * 1e6,
+        'ops_per_second': number / best if best else None,
+    }
+
+
+def bench_serialize_request(repeat: int) -> list:
+    results = []
+    for env_size in ENV_SIZES:
+        request = create_request(env_size)
+        results.append(
+            measure(
+                'serialize_request',
+                lambda request=request: serialize_request(request),
+                number=2000,
+                repeat=repeat,
+                env_size=env_size,
+            )
+        )
+    return results
+
+
+def bench_deserialize_request(registry, repeat: int) -> list:
+    results = []
+    for env_size in ENV_SIZES:
+        data = serialize_request(create_request(env_size))
+        results.append(
+            measure(
+                'deserialize_request',
+                lambda data=data: deserialize_request(data, registry),
+                number=2000,
+                repeat=repeat,
+                env_size=env_size,
+            )
+        )
+    return results
+
+
+def bench_publish(registry, repeat: int) -> list:
+    tasks_queue = TasksQueue(registry)
+    results = []
+    for env_size in ENV_SIZES:
+        request = create_request(env_size)
+        request.registry = registry
+
+        def publish():
+            benchmark_task.delay(1)
+
+        with RequestContext(request):
+            results.append(
+                measure(
+                    'publish',
+                    publish,
+                    number=500,
+                    repeat=repeat,
+                    env_size=env_size,
+                )
+            )
+            results.append(
+                measure(
+                    'get_request_extra',
+                    lambda request=request: get_request_extra(request),
+                    number=10000,
+                    repeat=repeat,
+                    env_size=env_size,
+                )
+            )
+        tasks_queue.clear()
+    return results
+
+
+def bench_task_proxy(repeat: int) -> list:
+    celery_task = benchmark_task.celery_task
+    results = []
+    for attr in ('name', 'delay', 's', 'max_retries'):
+        results.append(
+            measure(
+                'task_proxy_getattr',
+                lambda attr=attr: getattr(benchmark_task, attr),
+                number=100000,
+                repeat=repeat,
+                attr=attr,
+            )
+        )
+        results.append(
+            measure(
+                'celery_task_getattr',
+                lambda attr=attr: getattr(celery_task, attr),
+                number=100000,
+                repeat=repeat,
+                attr=attr,
+            )
+        )
+    return results
+
+
+def bench_router(repeat: int) -> list:
+    results = []
+    for queues_count in (10, 100, 1000):
+        exchange = Exchange('bench', type='direct')
+        queues = [
+            Queue(f'bench.{i}', exchange, routing_key=f'key_{i}')
+            for i in range(queues_count)
+        ]
+        app = Celery('bench', broker='memory://', set_as_current=False)
+        app.conf.update(
+            task_queues=queues,
+            task_default_exchange='bench',
+            task_default_queue='bench.0',
+        )
+        fake_task = SimpleNamespace(app=app)
+        router = RouterByRoutingKey(default_queue_name='bench.0')
+        options = {'routing_key': f'key_{queues_count - 1}'}
+        results.append(
+            measure(
+                'router_by_routing_key',
+                lambda router=router, options=options, task=fake_task: router(
+                    't', (), {}, options, task=task
+                ),
+                number=20000,
+                repeat=repeat,
+                queues=queues_count,
+            )
+        )
+    return results
+
+
+def bench_tasks_queue(registry, repeat: int) -> list:
+    tasks_queue = TasksQueue(registry)
+    request = create_request()
+    request.registry = registry
+    count = 200
+
+    def publish_and_run():
+        for i in range(count):
+            benchmark_task.delay(i)
+        tasks_queue.run_all_tasks()
+
+    with RequestContext(request):
+        result = measure(
+            'tasks_queue_end_to_end',
+            publish_and_run,
+            number=1,
+            repeat=repeat,
+            tasks=count,
+        )
+    result['us_per_op'] /= count
+    return [result]
+
+
+def run_benchmarks(repeat: int = 5, name_filter: str = '') -> dict:
+    request = Request.blank('http://localhost')
+    with testing.testConfig(request=request) as config:
+        config.include('pcelery')
+        config.set_celery_config({'testing': True})
+        config.scan(__name__)
+        config.commit()
+        registry = config.registry
+        get_celery(registry)
+
+        suites = [
+            ('serialize_request', lambda: bench_serialize_request(repeat)),
+            (
+                'deserialize_request',
+                lambda: bench_deserialize_request(registry, repeat),
+            ),
+            ('publish', lambda: bench_publish(registry, repeat)),
+            ('task_proxy', lambda: bench_task_proxy(repeat)),
+            ('router', lambda: bench_router(repeat)),
+            ('tasks_queue', lambda: bench_tasks_queue(registry, repeat)),
+        ]
+        results = []
+        for suite_name, suite in suites:
+            if name_filter in suite_name:
+                results.extend(suite())
+
+    return {
+        'environment': get_environment(),
+        'results': results,
+    }
+
+
+def get_environment() -> dict:
+    versions = {}
+    for package in ('pcelery', 'celery', 'kombu', 'pyramid', 'webob'):
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return {
+        'python': sys.version,
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'packages': versions,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run benchmarks of pcelery')
+    parser.add_argument(
+        '--output',
+        help='Path to file to write results (JSON). By default results are '
+        'printed to stdout.',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='Number of repeats of every benchmark (the best one is used).',
+    )
+    parser.add_argument(
+        '--filter',
+        default='',
+        help='Run only suites which name contains the given string.',
+    )
+    parsed_args = parser.parse_args(args)
+    results = run_benchmarks(parsed_args.repeat, parsed_args.filter)
+    data = json.dumps(results, indent=2)
+    if parsed_args.output:
+        with open(parsed_args.output, 'w') as f:
+            f.write(data)
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
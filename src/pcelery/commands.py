@@ -14,6 +14,8 @@ from celery.bin.celery import celery as celery_main
 from pyramid.paster import bootstrap
 from pyramid.util import DottedNameResolver
 
+from .manifest import REBUILD_MANIFEST_ENV
+from .task_registry import LazyTaskRegistry
 from .utils import get_celery
 
 
@@ -45,12 +47,36 @@ def pcelery(args=None):
         return run_celery(env['request'], args=unknown_args)
 
 
+def pcelery_manifest(args=None):
+    """Rebuild manifests of tasks used by ``config.scan_celery_tasks()``."""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Rebuild manifests of tasks')
+    parser.add_argument(
+        '--ini',
+        required=True,
+        help='The URI to the pyramid configuration file.',
+    )
+    parsed_args = parser.parse_args(args)
+    os.environ[REBUILD_MANIFEST_ENV] = '1'
+    try:
+        with bootstrap(parsed_args.ini):
+            pass
+    finally:
+        del os.environ[REBUILD_MANIFEST_ENV]
+
+
 def run_celery(request, args: List[str], add_ini_option=True):
     app = getattr(request.registry, 'celery', None)
     if not app:
         app = get_celery(request.registry)
     os.environ['CELERY_LOADER'] = 'pcelery.loader.PyramidCeleryLoader'
     app.set_default()
+    if isinstance(app.tasks, LazyTaskRegistry):
+        # Worker creates execution strategies for all registered tasks
+        # at startup, so lazy tasks must be created before it.
+        app.tasks.materialize_all()
     if add_ini_option:
         app.user_options['preload'].add(add_preload_arguments)
     return celery_main(args, auto_envvar_prefix='CELERY')
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+"""
+
+import importlib
+import json
+import logging
+import os
+from types import ModuleType
+from typing import Optional
+
+import venusian
+from pyramid.config import Configurator
+
+from .utils import TaskProxy, add_task_action
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+REBUILD_MANIFEST_ENV = 'PCELERY_REBUILD_TASK_MANIFEST'
+# Category of venusian callbacks that only collect tasks
+SCAN_CATEGORY = 'pcelery'
+
+
+def scan_celery_tasks(
+    config: Configurator,
+    package=None,
+    manifest_path: Optional[str] = None,
+    onerror=None,
+    ignore=None,
+):
+    """Register tasks of the package.
+
+    Only tasks are registered, other decorated objects (views,
+    subscribers and etc.) are not, so it doesn't replace ``config.scan()``.
+    Arguments ``onerror`` and ``ignore`` are passed to the scanner.
+
+    If ``manifest_path`` is given and the manifest file exists and
+    modification times of all python files of the package are not changed
+    since creation of the manifest, only modules with tasks listed
+    in the manifest are imported. Else the package is scanned and
+    the manifest is written again.
+
+    Set environment variable ``PCELERY_REBUILD_TASK_MANIFEST`` (or use
+    ``pcelery_manifest`` command) to force rebuilding of manifests.
+    """
+    package = config.maybe_dotted(package) if package else config.package
+    if manifest_path and not os.environ.get(REBUILD_MANIFEST_ENV):
+        manifest = load_task_manifest(manifest_path, package)
+        if manifest is not None:
+            for item in manifest['tasks']:
+                module = importlib.import_module(item['module'])
+                proxy = getattr(module, item['attr'])
+                add_task_action(config, item['attr'], proxy)
+            return
+
+    tasks = []
+    scanner = venusian.Scanner(pcelery_tasks=tasks)
+    scanner.scan(package, categories=(SCAN_CATEGORY,), onerror=onerror, ignore=ignore)
+    for attr, proxy in tasks:
+        add_task_action(config, attr, proxy)
+    if manifest_path:
+        try:
+            write_task_manifest(manifest_path, package, tasks)
+        except OSError as e:
+            logger.warning('Failed to write tasks manifest %s: %s', manifest_path, e)
+
+
+def write_task_manifest(
+    path: str,
+    package: ModuleType,
+    tasks: list[tuple[str, TaskProxy]],
+):
+    """Write manifest of tasks found in the package.
+
+    :param path: path to the manifest file
+    :param package: scanned package
+    :param tasks: list of pairs ``(attribute name, task proxy)``
+    """
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'package': package.__name__,
+        'files': _get_package_files(package),
+        'tasks': [
+            {
+                'module': proxy.original_func.__module__,
+                'attr': attr,
+                'name': proxy.task_options.get('name') or proxy.name,
+                'options': proxy.task_options,
+            }
+            for attr, proxy in tasks
+        ],
+    }
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, default=repr)
+    os.replace(tmp_path, path)
+
+
+def load_task_manifest(path: str, package: ModuleType) -> Optional[dict]:
+    """Returns manifest of tasks or ``None`` if it is not exists or outdated."""
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (
+        not isinstance(manifest, dict)
+        or manifest.get('version') != MANIFEST_VERSION
+        or manifest.get('package') != package.__name__
+        or manifest.get('files') != _get_package_files(package)
+    ):
+        return None
+    return manifest
+
+
+def _get_package_files(package: ModuleType) -> dict[str, int]:
+    """Returns modification times of python files of the package."""
+    paths = getattr(package, '__path__', None)
+    if paths is None:
+        path = package.__file__
+        return {path: os.stat(path).st_mtime_ns}
+    files = {}
+    for root in paths:
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names[:] = [d for d in dir_names if d != '__pycache__']
+            for file_name in file_names:
+                if file_name.endswith('.py'):
+                    path = os.path.join(dir_path, file_name)
+                    files[path] = os.stat(path).st_mtime_ns
+    return files
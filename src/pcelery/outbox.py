@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+"""
+
+import json
+import logging
+from concurrent.futures import Future
+from typing import Optional
+
+from celery import Task
+from pyramid.httpexceptions import HTTPException
+from pyramid.request import Request
+
+from .publisher import AsyncPublisher, get_async_publisher
+from .utils import apply_many
+
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_ONLY_ON_SUCCESS_KEY = 'pcelery_outbox_only_on_success'
+OUTBOX_ASYNC_KEY = 'pcelery_outbox_async'
+
+
+class TasksOutbox:
+    """Request-scoped buffer of tasks that will be published at the end
+    of the request.
+
+    Duplicates (the same task name, arguments and options) are published
+    only once. All tasks are published through one producer from
+    a finished callback of the request.
+
+    Pyramid calls finished callbacks before the response is sent
+    by WSGI server, so publishing delays the response unless
+    the ``publisher`` is given.
+
+    :param only_on_success: don't publish tasks if the request has been
+        finished with a response that has status code greater than
+        or equal to 400 or, without response, with an exception
+        (``request.exception``) other than HTTP exception with status
+        code less than 400. Tasks are published if there was neither
+        response nor exception (e.g. in scripts or tasks).
+    :param publisher: publish tasks from the thread of this publisher
+        instead of the finished callback.
+    """
+
+    def __init__(
+        self,
+        request: Request,
+        only_on_success=False,
+        publisher: Optional[AsyncPublisher] = None,
+    ):
+        self.request = request
+        self.only_on_success = only_on_success
+        self.publisher = publisher
+        self.response_status: Optional[int] = None
+        self._calls: dict = {}
+        self._callbacks_added = False
+
+    def __len__(self):
+        return len(self._calls)
+
+    def add(self, task: Task, args=None, kwargs=None, **options):
+        """Add task into the outbox. Returns ``False`` if such task
+        already exists in the outbox."""
+        key = _get_call_key(task.name, args, kwargs, options)
+        if key in self._calls:
+            return False
+        self._calls[key] = (task, args, kwargs, options)
+        if not self._callbacks_added:
+            self._callbacks_added = True
+            self.request.add_response_callback(self._response_callback)
+            self.request.add_finished_callback(self._finished_callback)
+        return True
+
+    def clear(self):
+        self._calls.clear()
+
+    def _take_calls(self) -> list:
+        calls = list(self._calls.values())
+        self._calls.clear()
+        return calls
+
+    def flush(self) -> list:
+        """Publish all tasks from the outbox. Returns list of ``AsyncResult``."""
+        calls = self._take_calls()
+        if not calls:
+            return []
+        return apply_many(calls[0][0].app, calls)
+
+    def flush_async(self) -> Optional[Future]:
+        """Publish all tasks from the outbox by the thread of publisher.
+
+        Returns future of list of ``AsyncResult`` or ``None``
+        if the outbox is empty.
+        """
+        calls = self._take_calls()
+        if not calls:
+            return None
+        future = self.publisher.submit(
+            apply_many, calls[0][0].app, calls, request=self.request
+        )
+        future.add_done_callback(_log_flush_error)
+        return future
+
+    def _response_callback(self, request, response):
+        self.response_status = response.status_code
+
+    def _is_failed(self, request) -> bool:
+        if self.response_status is not None:
+            return self.response_status >= 400
+        exception = getattr(request, 'exception', None)
+        if exception is None:
+            return False
+        if isinstance(exception, HTTPException):
+            return exception.status_code >= 400
+        return True
+
+    def _finished_callback(self, request):
+        self._callbacks_added = False
+        is_failed = self._is_failed(request)
+        self.response_status = None
+        if self.only_on_success and is_failed:
+            self.clear()
+        elif self.publisher is not None:
+            self.flush_async()
+        else:
+            self.flush()
+
+
+def _get_call_key(name, args, kwargs, options) -> tuple:
+    try:
+        key = (
+            name,
+            tuple(args or ()),
+            tuple(sorted((kwargs or {}).items())),
+            tuple(sorted(options.items())),
+        )
+        hash(key)
+    except TypeError:
+        # Arguments contain unhashable values
+        key = (
+            name,
+            json.dumps(
+                [args or (), kwargs or {}, options], sort_keys=True, default=repr
+            ),
+        )
+    return key
+
+
+def _log_flush_error(future: Future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(
+            'Publishing of tasks from outbox has failed',
+            exc_info=future.exception(),
+        )
+
+
+def get_tasks_outbox(request: Request) -> TasksOutbox:
+    """Request method that creates outbox of tasks (``request.pcelery_outbox``)."""
+    registry = request.registry
+    only_on_success = registry.get(OUTBOX_ONLY_ON_SUCCESS_KEY, False)
+    publisher = None
+    if registry.get(OUTBOX_ASYNC_KEY, False):
+        publisher = get_async_publisher(registry)
+    return TasksOutbox(request, only_on_success=only_on_success, publisher=publisher)
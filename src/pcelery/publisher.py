@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+"""
+
+import asyncio
+import atexit
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Awaitable, Optional
+
+from celery import Task
+from celery.result import AsyncResult
+from pyramid.registry import Registry
+from pyramid.request import Request
+
+from .base_task import CapturedRequest
+
+
+ASYNC_PUBLISHER_KEY = 'pcelery_async_publisher'
+ASYNC_PUBLISH_QUEUE_SIZE_KEY = 'pcelery_async_publish_queue_size'
+DEFAULT_QUEUE_SIZE = 1000
+# Seconds to wait for publishing of queued messages at interpreter exit
+EXIT_TIMEOUT = 10.0
+# Max seconds of waiting of the feeder for a free slot in the queue
+FEED_WAIT_TIMEOUT = 0.1
+
+_publisher_lock = threading.Lock()
+
+
+class PublisherStopped(RuntimeError):
+    """The publisher has been stopped before the message was queued."""
+
+
+class AsyncPublisher:
+    """Publishes messages of tasks from a dedicated thread.
+
+    Callers only put messages into a bounded queue and await a result,
+    so latency of the event loop is not tied to round-trips to the broker.
+    If the queue is full, messages are kept in order in an overflow list
+    that is moved into the queue by a feeder thread as soon as there are
+    free slots, so the caller is not blocked even if it never awaits
+    the result.
+
+    The thread is started on first publishing and is started again
+    in a child process after fork. At interpreter exit queued messages
+    are published during ``EXIT_TIMEOUT`` seconds at most.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._overflow = deque()
+        self._feeding = False
+        self._atexit_registered = False
+
+    def _get_queue(self) -> queue.Queue:
+        """Returns the queue of messages, starts the thread if needed.
+
+        Must be called with acquired lock.
+        """
+        if self._pid != os.getpid():
+            self._queue = queue.Queue(self.maxsize)
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(self._queue,),
+                name='pcelery-publisher',
+                daemon=True,
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+            self._overflow = deque()
+            self._feeding = False
+            if not self._atexit_registered:
+                atexit.register(self.stop, EXIT_TIMEOUT)
+                self._atexit_registered = True
+        return self._queue
+
+    @staticmethod
+    def _run(messages: queue.Queue):
+        while True:
+            item = messages.get()
+            if item is None:
+                break
+            future, fn, args, kwargs, captured = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                with captured:
+                    result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def _put(self, item):
+        with self._lock:
+            messages = self._get_queue()
+            if not self._overflow:
+                try:
+                    messages.put_nowait(item)
+                    return
+                except queue.Full:
+                    pass
+            self._overflow.append(item)
+            if self._feeding:
+                return
+            self._feeding = True
+        threading.Thread(
+            target=self._feed,
+            args=(messages,),
+            name='pcelery-publisher-feeder',
+            daemon=True,
+        ).start()
+
+    def _feed(self, messages: queue.Queue):
+        """Move messages from the overflow list into the queue."""
+        while True:
+            with self._lock:
+                if self._queue is not messages or not self._overflow:
+                    self._feeding = False
+                    return
+                try:
+                    messages.put_nowait(self._overflow[0])
+                except queue.Full:
+                    pass
+                else:
+                    self._overflow.popleft()
+                    continue
+            # Wait for a free slot, the timeout covers the slot released
+            # between the failed put and the wait.
+            with messages.not_full:
+                messages.not_full.wait(FEED_WAIT_TIMEOUT)
+
+    def apply_async(
+        self, task: Task, args=None, kwargs=None, **options
+    ) -> Awaitable[AsyncResult]:
+        """Publish a message of the task from the publisher thread.
+
+        Current Pyramid request and the request envelope are captured,
+        and the message is queued during the call, before the returned
+        awaitable is awaited.
+        """
+        future = Future()
+        captured = CapturedRequest(task.name)
+        self._put((future, task.apply_async, (args, kwargs), options, captured))
+        return asyncio.wrap_future(future)
+
+    def submit(self, fn, *args, request: Optional[Request] = None, **kwargs) -> Future:
+        """Call the function from the publisher thread.
+
+        The given (or current) Pyramid request is captured during the call
+        and is current while the function is executed.
+        """
+        future = Future()
+        captured = CapturedRequest(request=request)
+        self._put((future, fn, args, kwargs, captured))
+        return future
+
+    def stop(self, timeout: Optional[float] = None):
+        """Publish all queued messages and stop the thread.
+
+        If ``timeout`` is given, it limits both waiting for a free slot
+        in the queue and waiting for the thread. The thread is a daemon,
+        so it doesn't prevent exit of interpreter if it is still running.
+        Futures of messages that are still waiting for a free slot
+        in the queue fail with ``PublisherStopped``.
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            else:
+                thread.join(timeout)
+            overflow = self._overflow
+            self._overflow = deque()
+            self._queue = None
+            self._thread = None
+            self._pid = None
+        for future, *_ in overflow:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(PublisherStopped())
+
+
+def get_async_publisher(registry: Registry) -> AsyncPublisher:
+    """Returns the publisher of tasks shared by all event loops
+    of the registry."""
+    publisher = registry.get(ASYNC_PUBLISHER_KEY)
+    if publisher is None:
+        with _publisher_lock:
+            publisher = registry.get(ASYNC_PUBLISHER_KEY)
+            if publisher is None:
+                maxsize = registry.get(ASYNC_PUBLISH_QUEUE_SIZE_KEY)
+                publisher = registry[ASYNC_PUBLISHER_KEY] = AsyncPublisher(
+                    maxsize or DEFAULT_QUEUE_SIZE
+                )
+    return publisher
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+
+Pytest plugin with Pyramid registry and Celery app shared by all tests
+of a session.
+
+Enable it in the root ``conftest.py`` of your tests:
+
+    .. code-block:: python
+
+        pytest_plugins = ['pcelery.pytest_plugin']
+
+
+        @pytest.fixture(scope='session')
+        def pcelery_setup():
+            def setup(config):
+                config.include('backend.users')
+
+            return setup
+
+Registry is configured once per session, and every test receives a clean
+state of Celery app (see ``pcelery.testing.reset_celery_state()``).
+"""
+
+import pytest
+from pyramid.config import Configurator
+from pyramid.interfaces import IRequestFactory
+from pyramid.request import Request, apply_request_extensions
+from pyramid.threadlocal import RequestContext
+
+from .testing import TasksQueue, reset_celery_state
+from .utils import get_celery
+
+
+@pytest.fixture(scope='session', name='pcelery_celery_config')
+def pcelery_celery_config_fixture():
+    """Celery configuration of the session registry."""
+    return {'testing': True}
+
+
+@pytest.fixture(scope='session', name='pcelery_settings')
+def pcelery_settings_fixture():
+    """Settings of the session registry."""
+    return {}
+
+
+@pytest.fixture(scope='session', name='pcelery_setup')
+def pcelery_setup_fixture():
+    """Callable that receives ``Configurator`` of the session registry
+    to include packages and scan tasks."""
+    return None
+
+
+@pytest.fixture(scope='session', name='pcelery_registry')
+def pcelery_registry_fixture(pcelery_settings, pcelery_celery_config, pcelery_setup):
+    config = Configurator(settings=pcelery_settings)
+    config.begin()
+    try:
+        config.include('pcelery')
+        config.set_celery_config(pcelery_celery_config)
+        if pcelery_setup is not None:
+            pcelery_setup(config)
+        config.commit()
+        get_celery(config.registry)
+    finally:
+        config.end()
+    return config.registry
+
+
+@pytest.fixture(name='pcelery_request')
+def pcelery_request_fixture(pcelery_registry):
+    """Pyramid request of the session registry that is current
+    during the test."""
+    reset_celery_state(pcelery_registry)
+    request_factory = pcelery_registry.queryUtility(IRequestFactory, default=Request)
+    request = request_factory.blank('http://localhost')
+    request.registry = pcelery_registry
+    apply_request_extensions(request)
+    with RequestContext(request):
+        yield request
+        request._process_finished_callbacks()
+
+
+@pytest.fixture(name='pcelery_tasks_queue')
+def pcelery_tasks_queue_fixture(pcelery_request):
+    return TasksQueue(pcelery_request.registry)
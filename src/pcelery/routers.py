@@ -4,6 +4,20 @@
 :Date: 03.08.2018
 """
 
+import hashlib
+import inspect
+from bisect import bisect
+from time import perf_counter
+from typing import Callable, Optional, Union
+from weakref import WeakKeyDictionary
+
+from kombu import Exchange, Queue
+from pyramid.registry import Registry
+from pyramid.threadlocal import get_current_request
+
+from .base_task import get_route_name
+from .stats import get_stats_sink
+
 
 class RouterByRoutingKey:
     """Routes tasks by it routing_key only.
@@ -39,15 +53,207 @@ class RouterByRoutingKey:
 
     def __init__(self, default_queue_name):
         self.default_queue_name = default_queue_name
+        # Number of routing keys that was found (hits) or not found (misses)
+        # in the routing table.
+        self.hits = 0
+        self.misses = 0
+        self._tables = WeakKeyDictionary()
 
     def __call__(self, name, args, kwargs, options, task=None, **kw):
+        if task is not None:
+            sink = get_stats_sink(getattr(task.app, 'pyramid_registry', None))
+            if sink is not None:
+                start = perf_counter()
+                try:
+                    return self._route(options, task)
+                finally:
+                    tags = {
+                        'task': name,
+                        'route': get_route_name(get_current_request()),
+                    }
+                    sink.observe('pcelery.publish.route', perf_counter() - start, tags)
+        return self._route(options, task)
+
+    def _route(self, options, task):
         routing_key = options.get('routing_key', None)
         if task and routing_key:
             # Find queue by it routing_key
-            celery_conf = task.app.conf
-            exchange_name = options.get('exchange') or celery_conf['task_default_exchange']
-            for queue in celery_conf['task_queues']:
-                if queue.exchange.name == exchange_name and queue.routing_key == routing_key:
-                    return queue.name
-            return celery_conf['task_default_queue'] or self.default_queue_name
+            table = self._get_table(task.app)
+            exchange_name = options.get('exchange') or table.default_exchange
+            queue_name = table.queues.get((exchange_name, routing_key))
+            if queue_name is not None:
+                self.hits += 1
+                return queue_name
+            self.misses += 1
+            return table.default_queue or self.default_queue_name
         return self.default_queue_name
+
+    def invalidate(self, app=None):
+        """Drop the routing table of the Celery app (or of all apps).
+
+        The table is rebuilt automatically if ``task_queues`` is replaced
+        by another list or queues are added or removed. Call this method
+        after replacing of queues in place.
+        """
+        if app is None:
+            self._tables.clear()
+        else:
+            self._tables.pop(app, None)
+
+    def _get_table(self, app) -> 'RoutingTable':
+        task_queues = app.conf['task_queues']
+        table = self._tables.get(app)
+        if table is None or not table.is_actual(task_queues):
+            table = self._tables[app] = RoutingTable(app.conf, task_queues)
+        return table
+
+
+class RoutingTable:
+    """Maps pairs ``(exchange name, routing key)`` to names of queues."""
+
+    __slots__ = (
+        'task_queues',
+        'queues_count',
+        'default_exchange',
+        'default_queue',
+        'queues',
+    )
+
+    def __init__(self, celery_conf, task_queues):
+        self.task_queues = task_queues
+        self.queues_count = len(task_queues or ())
+        self.default_exchange = celery_conf['task_default_exchange']
+        self.default_queue = celery_conf['task_default_queue']
+        queues = {}
+        for queue in task_queues or ():
+            key = (queue.exchange.name, queue.routing_key)
+            # The first matched queue wins, like in linear search.
+            queues.setdefault(key, queue.name)
+        self.queues = queues
+
+    def is_actual(self, task_queues) -> bool:
+        # Queues replaced in place are not detected,
+        # see RouterByRoutingKey.invalidate().
+        return task_queues is self.task_queues and (
+            len(task_queues or ()) == self.queues_count
+        )
+
+
+ShardKey = Union[str, int, Callable[[tuple, dict], object]]
+
+
+def _hash(value: str) -> int:
+    # Builtin hash() of strings is randomized between processes
+    digest = hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class ShardedRouter:
+    """Routes tasks to one of shard queues by consistent hash of an argument
+    of the task, so all tasks with the same key are executed by consumers
+    of one queue.
+
+    :param queue_prefix: prefix of names of shard queues
+        (``<queue_prefix>.<shard number>``).
+    :param shards: number of shard queues.
+    :param shard_keys: maps names of tasks to their argument that is used
+        as key: name of argument, its position or callable that receives
+        ``args`` and ``kwargs`` and returns key.
+    :param replicas: number of points of every queue in the hash ring.
+        Changing of number of shards moves only a part of keys to
+        other queues.
+
+    Tasks not listed in ``shard_keys`` or without the key are not routed
+    by this router.
+
+    Usage:
+
+        .. code-block:: python
+
+            def includeme(config):
+                config.include('pcelery')
+
+                router = ShardedRouter(
+                    'backend.shard',
+                    shards=8,
+                    shard_keys={'backend.tasks.reindex_tenant': 'tenant_id'},
+                )
+                config.add_celery_queues_factory(router.create_queues, name='shards')
+                celery_config = {
+                    ...
+                    'task_routes': [
+                        router,
+                        RouterByRoutingKey(default_queue_name='backend.middle'),
+                    ],
+                }
+
+                config.set_celery_config(celery_config)
+                config.scan()
+    """
+
+    def __init__(
+        self,
+        queue_prefix: str,
+        shards: int,
+        shard_keys: dict[str, ShardKey],
+        exchange_name: Optional[str] = None,
+        replicas: int = 100,
+    ):
+        if shards < 1:
+            raise ValueError('Number of shards must be positive')
+        self.queue_prefix = queue_prefix
+        self.shards = shards
+        self.shard_keys = shard_keys
+        self.exchange_name = exchange_name or queue_prefix
+        self.queue_names = [f'{queue_prefix}.{i}' for i in range(shards)]
+        ring = sorted(
+            (_hash(f'{queue_name}#{replica}'), queue_name)
+            for queue_name in self.queue_names
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in ring]
+        self._owners = [queue_name for _, queue_name in ring]
+        self._positions: dict[str, Optional[int]] = {}
+
+    def create_queues(self, registry: Registry) -> list:
+        """Factory of shard queues for ``add_celery_queues_factory()``."""
+        exchange = Exchange(self.exchange_name, type='direct')
+        return [
+            Queue(queue_name, exchange, routing_key=queue_name)
+            for queue_name in self.queue_names
+        ]
+
+    def get_queue_name(self, key) -> str:
+        """Returns name of queue for the given key."""
+        index = bisect(self._points, _hash(str(key)))
+        return self._owners[index % len(self._owners)]
+
+    def __call__(self, name, args, kwargs, options, task=None, **kw):
+        spec = self.shard_keys.get(name)
+        if spec is None:
+            return None
+        key = self._get_key(name, spec, args or (), kwargs or {}, task)
+        if key is None:
+            return None
+        return self.get_queue_name(key)
+
+    def _get_key(self, name, spec: ShardKey, args, kwargs, task):
+        if callable(spec):
+            return spec(args, kwargs)
+        if isinstance(spec, int):
+            return args[spec] if spec < len(args) else None
+        if spec in kwargs:
+            return kwargs[spec]
+        position = self._get_position(name, spec, task)
+        if position is not None and position < len(args):
+            return args[position]
+
+    def _get_position(self, name, arg_name: str, task) -> Optional[int]:
+        """Returns position of the named argument in signature of the task."""
+        if name not in self._positions:
+            if task is None:
+                return None
+            parameters = list(inspect.signature(task.run).parameters)
+            position = parameters.index(arg_name) if arg_name in parameters else None
+            self._positions[name] = position
+        return self._positions[name]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+"""
+
+import threading
+from typing import Optional
+
+from pyramid.config import Configurator
+from pyramid.registry import Registry
+
+
+STATS_SINK_KEY = 'pcelery_stats_sink'
+
+
+class StatsSink:
+    """Receiver of metrics collected by pcelery.
+
+    This base class ignores all metrics. Subclass it to send metrics into
+    your monitoring system.
+
+    Names of metrics:
+
+    - ``pcelery.task.<phase>`` - durations (in seconds) of phases of task
+      execution by worker: ``deserialize_request``, ``root_factory``,
+      ``context_begin``, ``run``, ``finished_callbacks``, ``context_end``.
+      Note that ``run`` includes ``deserialize_request`` and ``root_factory``
+      if the task uses Pyramid request. Tags: ``task``.
+    - ``pcelery.task.reused_request`` - counter of Pyramid requests reused
+      by tasks with ``reuse_pyramid_request``. Tags: ``task``.
+    - ``pcelery.publish.add_params`` - duration of adding of extra params
+      into a published message. Tags: ``task``, ``route``.
+    - ``pcelery.publish.serialize_request`` - duration of serialization of
+      HTTP request (once per request). Tags: ``route``.
+    - ``pcelery.publish.env_dropped`` - counter of environ items dropped
+      by size limits of ``RequestEnvFilter`` during serialization of HTTP
+      request. Tags: ``route``, ``key``.
+    - ``pcelery.publish.envelope_size`` - size of extra params serialized
+      into JSON. Tags: ``task``, ``route``.
+    - ``pcelery.publish.route`` - duration of routing by
+      ``RouterByRoutingKey``. Tags: ``task``, ``route``.
+    - ``pcelery.publish.messages`` - counter of published messages.
+      Tags: ``task``, ``route``, ``queue``.
+
+    Tag ``route`` is the name of matched route of current HTTP request
+    or empty string.
+    """
+
+    def incr(self, name: str, tags: dict, value: int = 1):
+        """Increase a counter."""
+
+    def observe(self, name: str, value: float, tags: dict):
+        """Add a value (duration or size) into a histogram."""
+
+
+class Aggregate:
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self) -> Optional[float]:
+        if self.count:
+            return self.total / self.count
+
+    def __repr__(self):
+        return (
+            f'Aggregate(count={self.count}, total={self.total}, '
+            f'min={self.min}, max={self.max})'
+        )
+
+
+class AggregatingStatsSink(StatsSink):
+    """Sink that aggregates metrics in memory by name and tags."""
+
+    def __init__(self):
+        self.stats: dict[tuple, Aggregate] = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, tags: dict, value: int = 1):
+        self.observe(name, value, tags)
+
+    def observe(self, name: str, value: float, tags: dict):
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            aggregate = self.stats.get(key)
+            if aggregate is None:
+                aggregate = self.stats[key] = Aggregate()
+            aggregate.add(value)
+
+    def get(self, name: str, **tags) -> Optional[Aggregate]:
+        return self.stats.get((name, tuple(sorted(tags.items()))))
+
+    def clear(self):
+        with self._lock:
+            self.stats.clear()
+
+
+def set_celery_stats_sink(config: Configurator, sink: Optional[StatsSink]):
+    """This function storing a sink of metrics in the pyramid registry."""
+    config.registry[STATS_SINK_KEY] = sink
+
+
+def get_stats_sink(registry: Optional[Registry]) -> Optional[StatsSink]:
+    if registry is not None:
+        return registry.get(STATS_SINK_KEY)
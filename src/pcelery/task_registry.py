@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+"""
+
+import threading
+from typing import Callable
+
+from celery.app.registry import TaskRegistry
+
+
+class LazyTaskRegistry(TaskRegistry):
+    """Registry of Celery tasks that creates tasks on first access.
+
+    Pending tasks are added by name with a factory that creates and
+    registers the task. The factory is called on first lookup of the task
+    by name (``tasks[name]`` or ``tasks.get(name)``). Lookup of unknown
+    name creates all pending tasks, because the name may be an alternative
+    name of some of them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending: dict[str, Callable[[], None]] = {}
+        self._lock = threading.RLock()
+
+    def add_pending(self, name: str, factory: Callable[[], None]):
+        self.pending[name] = factory
+
+    def materialize(self, name: str):
+        with self._lock:
+            factory = self.pending.pop(name, None)
+            if factory is not None:
+                factory()
+
+    def materialize_all(self):
+        with self._lock:
+            while self.pending:
+                name = next(iter(self.pending))
+                self.materialize(name)
+
+    def __getitem__(self, key):
+        if self.pending and key in self.pending:
+            self.materialize(key)
+        return super().__getitem__(key)
+
+    def __missing__(self, key):
+        if self.pending:
+            # Unknown name may be an alternative name of some pending task
+            self.materialize_all()
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+        return super().__missing__(key)
+
+    def get(self, key, default=None):
+        if not self.pending:
+            return dict.get(self, key, default)
+        try:
+            return self[key]
+        except self.NotRegistered:
+            return default
@@ -4,16 +4,193 @@
 :Date: 19.03.2017
 """
 
-from collections import deque
+import heapq
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import count, islice
+from queue import Queue
+from threading import Lock
 from typing import Optional, Any
 
 from billiard.einfo import ExceptionInfo, ExceptionWithTraceback
+from celery._state import _task_stack
+from celery.app.trace import trace_task
 from celery.exceptions import Retry
+from celery.utils.nodenames import gethostname
+from celery.utils.time import maybe_iso8601, maybe_make_aware
 from celery.worker.request import Request
+from celery.worker.state import revoked as revoked_tasks, revoked_stamps
+from kombu.compression import decompress
+from kombu.serialization import loads, prepare_accept_content
 from kombu.transport.memory import Channel
 from kombu.transport.virtual import Message
 from pyramid.registry import Registry
 
+from .utils import rebind_task_proxies
+
+
+def get_task_name(payload: dict) -> Optional[str]:
+    return payload['headers'].get('task')
+
+
+# Sequence numbers of messages are shared by all queues,
+# so they reflect the order of publishing across queues.
+_message_seq = count()
+
+
+def get_routing_key(payload: dict) -> Optional[str]:
+    return payload['properties'].get('delivery_info', {}).get('routing_key')
+
+
+def _add_to_index(index: dict, key, seq: int):
+    seqs = index.get(key)
+    if seqs is None:
+        seqs = index[key] = OrderedDict()
+    seqs[seq] = None
+
+
+def _remove_from_index(index: dict, key, seq: int):
+    seqs = index[key]
+    del seqs[seq]
+    if not seqs:
+        del index[key]
+
+
+class IndexedQueue:
+    """Deque-like container of message payloads with indexes by task names
+    and routing keys.
+
+    It replaces the deque inside of a queue of memory transport,
+    so counts of messages by task names and search of the oldest
+    or the last message of a task do not require a scan of the queue.
+    """
+
+    def __init__(self, payloads=()):
+        self._messages = OrderedDict()  # sequence number -> payload
+        self._by_name: dict[str, OrderedDict] = {}
+        self._by_routing_key: dict[str, OrderedDict] = {}
+        # Incremented on every change of the queue
+        self.version = 0
+        for payload in payloads:
+            self.append(payload)
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages.values())
+
+    def __getitem__(self, index: int) -> dict:
+        return self._messages[self._get_seq(index)]
+
+    def __delitem__(self, index: int):
+        self._remove(self._get_seq(index))
+
+    def _get_seq(self, index: int) -> int:
+        size = len(self._messages)
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError('queue index out of range')
+        if index < size // 2:
+            return next(islice(self._messages, index, None))
+        return next(islice(reversed(self._messages), size - index - 1, None))
+
+    def _remove(self, seq: int) -> dict:
+        payload = self._messages.pop(seq)
+        _remove_from_index(self._by_name, get_task_name(payload), seq)
+        _remove_from_index(self._by_routing_key, get_routing_key(payload), seq)
+        self.version += 1
+        return payload
+
+    def append(self, payload: dict):
+        seq = next(_message_seq)
+        self._messages[seq] = payload
+        _add_to_index(self._by_name, get_task_name(payload), seq)
+        _add_to_index(self._by_routing_key, get_routing_key(payload), seq)
+        self.version += 1
+
+    def popleft(self) -> dict:
+        if not self._messages:
+            raise IndexError('pop from an empty queue')
+        return self._remove(next(iter(self._messages)))
+
+    def pop(self) -> dict:
+        if not self._messages:
+            raise IndexError('pop from an empty queue')
+        return self._remove(next(reversed(self._messages)))
+
+    def clear(self):
+        self._messages.clear()
+        self._by_name.clear()
+        self._by_routing_key.clear()
+        self.version += 1
+
+    @property
+    def oldest_seq(self) -> Optional[int]:
+        """Sequence number of the oldest message."""
+        return next(iter(self._messages), None)
+
+    def count_by_name(self, name: str) -> int:
+        seqs = self._by_name.get(name)
+        return len(seqs) if seqs else 0
+
+    def count_by_routing_key(self, routing_key: str) -> int:
+        seqs = self._by_routing_key.get(routing_key)
+        return len(seqs) if seqs else 0
+
+    def items_by_routing_key(self, routing_key: str) -> list[tuple[int, dict]]:
+        """Returns pairs of sequence number and payload of messages
+        with the routing key."""
+        seqs = self._by_routing_key.get(routing_key) or ()
+        return [(seq, self._messages[seq]) for seq in seqs]
+
+    def pop_oldest_by_name(self, name: str) -> Optional[dict]:
+        seqs = self._by_name.get(name)
+        if seqs:
+            return self._remove(next(iter(seqs)))
+
+    def pop_last_by_name(self, name: str) -> Optional[dict]:
+        seqs = self._by_name.get(name)
+        if seqs:
+            return self._remove(next(reversed(seqs)))
+
+
+def get_indexed_queue(queue_name: str) -> IndexedQueue:
+    """Returns payloads of the queue of memory transport.
+
+    The queue is created if it does not exist, and its deque is replaced
+    by ``IndexedQueue``.
+    """
+    queue = Channel.queues.get(queue_name)
+    if queue is None:
+        queue = Channel.queues.setdefault(queue_name, Queue())
+    payloads = queue.queue
+    if not isinstance(payloads, IndexedQueue):
+        with queue.mutex:
+            payloads = queue.queue
+            if not isinstance(payloads, IndexedQueue):
+                payloads = queue.queue = IndexedQueue(payloads)
+    return payloads
+
+
+def reset_celery_state(registry: Registry):
+    """Reset state of Celery app of the registry between tests that
+    share the app.
+
+    Clears all queues of memory transport and stacks of task requests,
+    and binds proxies of tasks to the app again.
+    """
+    celery = registry.celery
+    for queue in list(Channel.queues.values()):
+        queue.queue.clear()
+    for task in celery.tasks.values():
+        if task.request_stack is not None:
+            del task.request_stack.stack[:]
+    del _task_stack.stack[:]
+    rebind_task_proxies(registry)
+
 
 class TasksQueue:
     def __init__(
@@ -22,12 +199,24 @@ class TasksQueue:
         queue_name='pcelery.default',
         clear=True,
         disabled_tasks: Optional[set[str]] = None,
+        fast_execution=True,
     ):
+        """
+        :param fast_execution: execute tasks without creating of kombu
+            message and worker request (see ``execute_payload()``).
+            Arguments of tasks still pass through the serializer:
+            they are encoded on publishing and decoded before execution.
+        """
         self.registry = registry
         self._queue_name = queue_name
-        if queue_name in Channel.queues and clear:
-            Channel.queues[queue_name].queue.clear()
+        if clear:
+            self.queue.clear()
         self.disabled_tasks = disabled_tasks or set()
+        self.fast_execution = fast_execution
+        self._view_key = None
+        self._view = []
+        self._accept = None
+        self._hostname = gethostname()
 
     @property
     def _channel(self):
@@ -36,86 +225,158 @@ class TasksQueue:
                 return connection.transport.channels[0]
 
     @property
-    def queue(self):
-        if self._queue_name in Channel.queues:
-            return Channel.queues[self._queue_name].queue
-        return deque()
+    def queue(self) -> IndexedQueue:
+        return get_indexed_queue(self._queue_name)
 
     @property
     def task_names(self):
-        names = (m['headers']['task'] for m in self.queue)
+        names = (get_task_name(m) for m in self.queue)
         return (n for n in names if n not in self.disabled_tasks)
 
     def __len__(self):
-        return len(list(self.task_names))
+        queue = self.queue
+        disabled = sum(queue.count_by_name(name) for name in self.disabled_tasks)
+        return len(queue) - disabled
+
+    def _get_view(self) -> list:
+        """Returns cached list of payloads of enabled tasks."""
+        queue = self.queue
+        key = (id(queue), queue.version, frozenset(self.disabled_tasks))
+        if key != self._view_key:
+            disabled_tasks = self.disabled_tasks
+            self._view = [m for m in queue if get_task_name(m) not in disabled_tasks]
+            self._view_key = key
+        return self._view
 
     def __getitem__(self, key) -> Message:
         if not self._channel:
             raise KeyError(key)
-        queue = [
-            m for m in self.queue if m['headers']['task'] not in self.disabled_tasks
-        ]
-        return Message(queue[key], self._channel)
+        if self.disabled_tasks:
+            payload = self._get_view()[key]
+        else:
+            payload = self.queue[key]
+        return Message(payload, self._channel)
 
     def __contains__(self, item):
-        return any(item == name for name in self.task_names)
+        return self.get_count_by_name(item) > 0
 
     def _run(self, payload, ignore_errors=False):
-        message = Message(payload, self._channel)
-        req = Request(message, app=self.registry.celery)
-        exc_info: ExceptionInfo | Any = req.execute()
+        if self.fast_execution:
+            exc_info = self.execute_payload(payload)
+        else:
+            exc_info = self._execute_request(payload)
         if exc_info and not ignore_errors and isinstance(exc_info, ExceptionInfo):
             if isinstance(exc_info.exception, ExceptionWithTraceback):
                 raise exc_info.exception.exc
             raise exc_info.exception
         return exc_info
 
+    def _execute_request(self, payload: dict) -> ExceptionInfo | Any:
+        message = Message(payload, self._channel)
+        req = Request(message, app=self.registry.celery)
+        return req.execute()
+
+    def execute_payload(self, payload: dict):
+        """Execute the task message like ``Request.execute()`` does it.
+
+        The body, encoded by the producer on publishing, is decoded
+        by the serializer from the message (it must be allowed by
+        ``accept_content``), so the task receives arguments as a worker
+        does. The task is traced directly with a request built from
+        the message.
+        Messages that may be revoked (with ``expires`` header, revoked id
+        or stamps) are executed by ``Request.execute()``, which skips
+        them and marks them as revoked.
+        Returns the value returned by the tracer.
+        """
+        headers = payload['headers']
+        if (
+            headers.get('expires') is not None
+            or headers['id'] in revoked_tasks
+            or (revoked_stamps and headers.get('stamped_headers'))
+        ):
+            return self._execute_request(payload)
+        celery = self.registry.celery
+        if self._accept is None:
+            self._accept = prepare_accept_content(celery.conf.accept_content)
+        properties = payload['properties']
+        body = payload['body']
+        body_encoding = properties.get('body_encoding')
+        if body_encoding and body_encoding.lower() != 'utf-8':
+            body = Channel.codecs[body_encoding].decode(body)
+        if 'compression' in headers:
+            body = decompress(body, headers['compression'])
+        args, kwargs, embed = loads(
+            body,
+            payload['content-type'],
+            payload['content-encoding'],
+            accept=self._accept,
+        )
+        task = celery.tasks[headers['task']]
+        delivery_info = properties.get('delivery_info') or {}
+        request = headers.copy()
+        request.update(
+            {
+                'properties': properties,
+                'reply_to': properties.get('reply_to'),
+                'correlation_id': properties.get('correlation_id'),
+                'hostname': self._hostname,
+                'delivery_info': {
+                    'exchange': delivery_info.get('exchange'),
+                    'routing_key': delivery_info.get('routing_key'),
+                    'priority': properties.get('priority'),
+                    'redelivered': delivery_info.get('redelivered', False),
+                },
+                'args': args,
+                'kwargs': kwargs,
+                'loglevel': None,
+                'logfile': None,
+                'is_eager': False,
+            },
+            **embed or {},
+        )
+        retval, *_ = trace_task(
+            task,
+            headers['id'],
+            args,
+            kwargs,
+            request,
+            hostname=self._hostname,
+            loader=celery.loader,
+            app=celery,
+        )
+        return retval
+
     def get_count_by_name(self, name):
-        count = 0
-        for t_name in self.task_names:
-            if t_name == name:
-                count += 1
-        return count
+        if name in self.disabled_tasks:
+            return 0
+        return self.queue.count_by_name(name)
 
     def run_oldest_task(self, name=None, ignore_errors=False):
         queue = self.queue
-        if queue:
-            if not name:
-                while queue:
-                    payload = queue.popleft()
-                    if payload['headers']['task'] in self.disabled_tasks:
-                        continue
-                    return self._run(payload, ignore_errors)
-            else:
-                for i in range(len(queue)):
-                    task_name = queue[i]['headers']['task']
-                    if task_name in self.disabled_tasks:
-                        continue
-                    if task_name == name:
-                        payload = queue[i]
-                        del queue[i]
-                        return self._run(payload, ignore_errors)
+        if not name:
+            while queue:
+                payload = queue.popleft()
+                if get_task_name(payload) in self.disabled_tasks:
+                    continue
+                return self._run(payload, ignore_errors)
+        elif name not in self.disabled_tasks:
+            payload = queue.pop_oldest_by_name(name)
+            if payload is not None:
+                return self._run(payload, ignore_errors)
 
     def run_last_task(self, name=None, ignore_errors=False):
         queue = self.queue
-        if not self.queue:
-            return
         if not name:
             while queue:
-                payload = self.queue.pop()
-                if payload['headers']['task'] in self.disabled_tasks:
+                payload = queue.pop()
+                if get_task_name(payload) in self.disabled_tasks:
                     continue
                 return self._run(payload, ignore_errors)
-        else:
-            count = len(queue)
-            for i in range(count - 1, -1, -1):
-                task_name = queue[i]['headers']['task']
-                if task_name in self.disabled_tasks:
-                    continue
-                if task_name == name:
-                    payload = queue[i]
-                    del queue[i]
-                    return self._run(payload, ignore_errors)
+        elif name not in self.disabled_tasks:
+            payload = queue.pop_last_by_name(name)
+            if payload is not None:
+                return self._run(payload, ignore_errors)
 
     def run_tasks_by_name(
         self,
@@ -139,7 +400,34 @@ class TasksQueue:
             else:
                 count = self.get_count_by_name(name)
 
-    def run_all_tasks(self, ignore_errors=False, max_retries=0, only_current=False):
+    def run_all_tasks(
+        self,
+        ignore_errors=False,
+        max_retries=0,
+        only_current=False,
+        concurrency=1,
+        fifo_per_task=True,
+        collect_errors=False,
+    ) -> list:
+        """Run all tasks from the queue.
+
+        :param concurrency: number of threads that run tasks in parallel.
+        :param fifo_per_task: if tasks run in parallel, messages of one task
+            are executed sequentially in order of publishing.
+        :param collect_errors: don't raise errors of tasks, but return
+            list of them after the queue is drained.
+        :return: list of collected errors, it is always empty if
+            ``collect_errors`` is ``False``.
+        """
+        if concurrency > 1 or collect_errors:
+            return self._run_all_tasks_parallel(
+                ignore_errors,
+                max_retries,
+                only_current,
+                concurrency,
+                fifo_per_task,
+                collect_errors,
+            )
         retries = 0
         count = len(self.queue)
         while count > 0:
@@ -154,6 +442,60 @@ class TasksQueue:
                 count = 0
             else:
                 count = len(self.queue)
+        return []
+
+    def _run_all_tasks_parallel(
+        self,
+        ignore_errors,
+        max_retries,
+        only_current,
+        concurrency,
+        fifo_per_task,
+        collect_errors,
+    ) -> list:
+        """Run tasks in a pool of threads by rounds. Every round runs
+        messages that were in the queue at its beginning.
+
+        Errors stop running after the current round.
+        """
+        errors = []
+        retries = 0
+        lock = Lock()
+
+        def run_chain(payloads):
+            nonlocal retries
+            for payload in payloads:
+                try:
+                    self._run(payload, ignore_errors)
+                except Retry as e:
+                    with lock:
+                        retries += 1
+                        if retries > max_retries:
+                            errors.append(e)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+
+        queue = self.queue
+        with ThreadPoolExecutor(concurrency, 'pcelery-tasks') as executor:
+            count = len(queue)
+            while count > 0:
+                chains = {}
+                for _ in range(count):
+                    payload = queue.popleft()
+                    name = get_task_name(payload)
+                    if name in self.disabled_tasks:
+                        continue
+                    key = name if fifo_per_task else len(chains)
+                    chains.setdefault(key, []).append(payload)
+                for future in [
+                    executor.submit(run_chain, payloads) for payloads in chains.values()
+                ]:
+                    future.result()
+                if errors and not collect_errors:
+                    raise errors[0]
+                count = 0 if only_current else len(queue)
+        return errors
 
     def clear(self):
         self.queue.clear()
@@ -161,13 +503,261 @@ class TasksQueue:
     def remove_oldest_task(self):
         queue = self.queue
         while queue:
-            payload = self.queue.popleft()
-            if payload['headers']['task'] not in self.disabled_tasks:
+            payload = queue.popleft()
+            if get_task_name(payload) not in self.disabled_tasks:
                 return
 
     def remove_last_task(self):
         queue = self.queue
         while queue:
-            payload = self.queue.pop()
-            if payload['headers']['task'] not in self.disabled_tasks:
+            payload = queue.pop()
+            if get_task_name(payload) not in self.disabled_tasks:
                 return
+
+
+class TasksBroker:
+    """View over queues of memory transport configured in Celery app.
+
+    Use it with key ``keep_queues`` of testing celery configuration,
+    to check routing of tasks into real queues.
+    Tasks are executed in order of publishing across all queues
+    configured in Celery app.
+    """
+
+    def __init__(
+        self,
+        registry: Registry,
+        clear=True,
+        disabled_tasks: Optional[set[str]] = None,
+        fast_execution=True,
+    ):
+        self.registry = registry
+        self.disabled_tasks = disabled_tasks or set()
+        self.fast_execution = fast_execution
+        self._tasks_queues: dict[str, TasksQueue] = {}
+        # Queues are indexed before publishing of messages into them,
+        # so sequence numbers of messages keep the order of publishing.
+        for queue_name in registry.celery.amqp.queues:
+            get_indexed_queue(queue_name)
+        if clear:
+            self.clear()
+
+    @property
+    def queue_names(self) -> list[str]:
+        # Queues of memory transport are shared by all Celery apps
+        # of the process, so only queues of this app are listed.
+        return list(self.registry.celery.amqp.queues)
+
+    def get_queue(self, queue_name: str) -> TasksQueue:
+        tasks_queue = self._tasks_queues.get(queue_name)
+        if tasks_queue is None:
+            tasks_queue = self._tasks_queues[queue_name] = TasksQueue(
+                self.registry,
+                queue_name,
+                clear=False,
+                disabled_tasks=self.disabled_tasks,
+                fast_execution=self.fast_execution,
+            )
+        return tasks_queue
+
+    def __getitem__(self, queue_name: str) -> TasksQueue:
+        return self.get_queue(queue_name)
+
+    def __len__(self):
+        return sum(self.get_counts().values())
+
+    def get_counts(self) -> dict[str, int]:
+        """Returns numbers of messages by queue names."""
+        return {name: len(self.get_queue(name)) for name in self.queue_names}
+
+    def get_count_by_name(self, name: str) -> int:
+        return sum(self.get_queue(q).get_count_by_name(name) for q in self.queue_names)
+
+    def _get_delivery_keys(self, routing_key: str):
+        """Yields names of queues and routing keys of messages that
+        were published with the routing key.
+
+        Celery publishes messages into direct exchanges through
+        the anonymous exchange with name of queue as routing key,
+        so such messages are found by binding key of their queue.
+        """
+        queues = self.registry.celery.amqp.queues
+        for name in self.queue_names:
+            yield name, routing_key
+            queue = queues.get(name)
+            if queue is not None and queue.routing_key == routing_key:
+                if name != routing_key:
+                    yield name, name
+
+    def get_count_by_routing_key(self, routing_key: str) -> int:
+        return sum(
+            get_indexed_queue(name).count_by_routing_key(key)
+            for name, key in self._get_delivery_keys(routing_key)
+        )
+
+    def get_messages_by_routing_key(self, routing_key: str) -> list[Message]:
+        """Returns messages published with the routing key
+        in order of publishing."""
+        items = []
+        for name, key in self._get_delivery_keys(routing_key):
+            items.extend(get_indexed_queue(name).items_by_routing_key(key))
+        items.sort(key=lambda item: item[0])
+        channel = self.get_queue(self.queue_names[0])._channel if items else None
+        return [Message(payload, channel) for _, payload in items]
+
+    def _get_oldest_queue(self) -> Optional[TasksQueue]:
+        oldest = None
+        oldest_seq = None
+        for name in self.queue_names:
+            seq = get_indexed_queue(name).oldest_seq
+            if seq is not None and (oldest_seq is None or seq < oldest_seq):
+                oldest = name
+                oldest_seq = seq
+        return None if oldest is None else self.get_queue(oldest)
+
+    def run_oldest_task(self, ignore_errors=False):
+        """Run the oldest task from all queues."""
+        while True:
+            tasks_queue = self._get_oldest_queue()
+            if tasks_queue is None:
+                return
+            payload = tasks_queue.queue.popleft()
+            if get_task_name(payload) not in self.disabled_tasks:
+                return tasks_queue._run(payload, ignore_errors)
+
+    def _get_total(self) -> int:
+        return sum(len(get_indexed_queue(name)) for name in self.queue_names)
+
+    def run_all_tasks(self, ignore_errors=False, max_retries=0, only_current=False):
+        retries = 0
+        count = self._get_total()
+        while count > 0:
+            for _ in range(count):
+                try:
+                    self.run_oldest_task(ignore_errors=ignore_errors)
+                except Retry:
+                    if max_retries <= retries:
+                        raise
+                    retries += 1
+            if only_current:
+                count = 0
+            else:
+                count = self._get_total()
+
+    def clear(self):
+        for name in self.queue_names:
+            get_indexed_queue(name).clear()
+
+
+class TasksScheduler:
+    """Runs tasks from ``TasksQueue`` in order of their ETA in virtual time.
+
+    The scheduler replaces ``celery.now()``, so ETA of tasks published
+    with ``countdown`` (including retries) is computed from virtual time.
+    Tasks without ETA are due immediately. Time moves only by calls
+    of ``advance()`` and ``run_until_empty()``.
+
+    Use the scheduler as a context manager or call ``close()`` to restore
+    ``celery.now()``.
+    """
+
+    def __init__(self, tasks_queue: TasksQueue, start: Optional[datetime] = None):
+        self.tasks_queue = tasks_queue
+        self.celery = tasks_queue.registry.celery
+        self.now = start or datetime.now(timezone.utc)
+        self._heap = []  # (eta, sequence number, payload)
+        self._seq = count()
+        self._closed = False
+        self.celery.now = self._get_now
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        self._collect()
+        return len(self._heap)
+
+    def _get_now(self) -> datetime:
+        return self.now
+
+    def close(self):
+        if not self._closed:
+            self.celery.__dict__.pop('now', None)
+            self._closed = True
+
+    def _collect(self):
+        """Move messages from the queue into the heap."""
+        tasks_queue = self.tasks_queue
+        queue = tasks_queue.queue
+        disabled = []
+        while queue:
+            payload = queue.popleft()
+            if get_task_name(payload) in tasks_queue.disabled_tasks:
+                disabled.append(payload)
+                continue
+            eta = payload['headers'].get('eta')
+            if eta is None:
+                eta = self.now
+            else:
+                eta = maybe_make_aware(maybe_iso8601(eta), timezone.utc)
+            heapq.heappush(self._heap, (eta, next(self._seq), payload))
+        for payload in disabled:
+            queue.append(payload)
+
+    @property
+    def next_eta(self) -> Optional[datetime]:
+        """ETA of the nearest task or None if there are no tasks."""
+        self._collect()
+        return self._heap[0][0] if self._heap else None
+
+    def advance(self, seconds: float, ignore_errors=False) -> int:
+        """Move the virtual time forward and run all due tasks."""
+        self.now += timedelta(seconds=seconds)
+        return self.run_due_tasks(ignore_errors)
+
+    def run_due_tasks(self, ignore_errors=False) -> int:
+        """Run tasks which ETA is not later than the virtual time,
+        including tasks that became due during this run.
+
+        Retries of tasks are not errors, they are scheduled again.
+        Returns number of executed tasks.
+        """
+        heap = self._heap
+        executed = 0
+        self._collect()
+        while heap and heap[0][0] <= self.now:
+            payload = heapq.heappop(heap)[2]
+            executed += 1
+            try:
+                self.tasks_queue._run(payload, ignore_errors)
+            except Retry:
+                pass
+            finally:
+                self._collect()
+        return executed
+
+    def run_until_empty(
+        self, max_seconds: Optional[float] = None, ignore_errors=False
+    ) -> int:
+        """Move the virtual time to ETA of the next task and run due tasks
+        until there are no tasks or ``max_seconds`` of virtual time is passed.
+        Use ``max_seconds`` if tasks may retry infinitely.
+
+        Returns number of executed tasks.
+        """
+        deadline = None
+        if max_seconds is not None:
+            deadline = self.now + timedelta(seconds=max_seconds)
+        executed = self.run_due_tasks(ignore_errors)
+        while True:
+            next_eta = self.next_eta
+            if next_eta is None or (deadline is not None and next_eta > deadline):
+                break
+            self.now = max(self.now, next_eta)
+            executed += self.run_due_tasks(ignore_errors)
+        if deadline is not None and self.now < deadline:
+            self.now = deadline
+        return executed
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+"""
+
+from ..benchmarks import run_benchmarks
+
+
+def test_run_benchmarks():
+    data = run_benchmarks(repeat=1, name_filter='router')
+    assert data['environment']['packages']['celery']
+    results = data['results']
+    assert [r['params']['queues'] for r in results] == [10, 100, 1000]
+    assert all(r['us_per_op'] > 0 for r in results)
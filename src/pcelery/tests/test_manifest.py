@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+"""
+
+import json
+
+from pyramid import testing
+from pyramid.events import subscriber
+from pyramid.request import Request
+
+from .. import get_celery
+from .. import manifest as manifest_module
+from ..manifest import load_task_manifest
+from .. import tests
+from . import test_task
+
+
+class ManifestEvent:
+    pass
+
+
+@subscriber(ManifestEvent)
+def manifest_event_subscriber(event):
+    event.handled = True
+
+
+def scan_tasks(manifest_path, monkeypatch=None):
+    request = Request.blank('http://localhost')
+    with testing.testConfig(request=request) as config:
+        config.include('pcelery')
+        config.set_celery_config({'testing': True})
+        if monkeypatch:
+            monkeypatch.setattr(manifest_module.venusian, 'Scanner', None)
+        config.scan_celery_tasks('pcelery.tests', manifest_path=str(manifest_path))
+        config.commit()
+        # Only tasks are registered
+        event = ManifestEvent()
+        config.registry.notify(event)
+        assert not hasattr(event, 'handled')
+        return get_celery(config.registry)
+
+
+def test_tasks_manifest(tmp_path, monkeypatch):
+    manifest_path = tmp_path / 'tasks.json'
+    celery = scan_tasks(manifest_path)
+    assert test_task.first_task.name in celery.tasks
+    scanned_names = set(celery.tasks)
+
+    manifest = load_task_manifest(str(manifest_path), tests)
+    assert manifest is not None
+    tasks = {t['name']: t for t in manifest['tasks']}
+    first_task = tasks[test_task.first_task.name]
+    assert first_task['module'] == 'pcelery.tests.test_task'
+    assert first_task['attr'] == 'first_task'
+    assert first_task['options'] == {'bind': True, 'max_retries': 100}
+
+    # Package is not scanned if manifest is actual
+    celery = scan_tasks(manifest_path, monkeypatch)
+    assert set(celery.tasks) == scanned_names
+    monkeypatch.undo()
+
+    # Outdated manifest is rebuilt
+    manifest['files'] = {}
+    manifest_path.write_text(json.dumps(manifest))
+    celery = scan_tasks(manifest_path)
+    assert test_task.first_task.name in celery.tasks
+    assert json.loads(manifest_path.read_text())['files']
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+"""
+
+import pytest
+from pyramid.threadlocal import get_current_request
+
+# Fixtures are imported to be found by pytest in this module
+from ..pytest_plugin import (  # noqa: F401
+    pcelery_celery_config_fixture,
+    pcelery_registry_fixture,
+    pcelery_request_fixture,
+    pcelery_settings_fixture,
+    pcelery_tasks_queue_fixture,
+)
+from .test_task import order_task_1, order_task_2
+
+
+@pytest.fixture(scope='session', name='pcelery_setup')
+def pcelery_setup_fixture():
+    def setup(config):
+        config.scan('pcelery.tests.test_task')
+
+    return setup
+
+
+@pytest.fixture(scope='session', name='seen_apps')
+def seen_apps_fixture():
+    """Registries and Celery apps received by tests of the session."""
+    return []
+
+
+@pytest.mark.parametrize('run', [1, 2])
+def test_session_registry(pcelery_request, pcelery_tasks_queue, seen_apps, run):
+    registry = pcelery_request.registry
+    assert get_current_request() is pcelery_request
+    assert order_task_1.celery_task.app is registry.celery
+    # The same registry and app are used by all tests
+    seen_apps.append((registry, registry.celery))
+    assert all(r is registry and app is registry.celery for r, app in seen_apps)
+
+    registry.tasks_order = []
+    order_task_1.delay()
+    order_task_2.delay()
+    # Messages left by other tests are dropped
+    assert len(pcelery_tasks_queue) == 2
+    pcelery_tasks_queue.run_all_tasks()
+    assert registry.tasks_order == [1, 2]
+    # Leave a message for other tests
+    order_task_1.delay()
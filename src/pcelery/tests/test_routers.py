@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+:Authors: cykooz
+:Date: 18.10.2026
+"""
+
+from types import SimpleNamespace
+
+from celery import Celery
+from kombu import Exchange, Queue
+
+from ..routers import RouterByRoutingKey, ShardedRouter
+from ..stats import AggregatingStatsSink
+
+
+def create_celery():
+    exchange = Exchange('backend.default', type='direct')
+    celery = Celery('test', broker='memory://')
+    celery.conf.update(
+        task_default_exchange='backend.default',
+        task_default_queue='backend.middle',
+        task_queues=[
+            Queue('backend.high', exchange, routing_key='high_priority'),
+            Queue('backend.middle', exchange, routing_key='middle_priority'),
+            Queue('other.high', Exchange('other'), routing_key='high_priority'),
+        ],
+    )
+    return celery
+
+
+def test_router_by_routing_key():
+    celery = create_celery()
+    task = SimpleNamespace(app=celery)
+    router = RouterByRoutingKey(default_queue_name='backend.low')
+
+    assert router('t', (), {}, {}, task=task) == 'backend.low'
+    options = {'routing_key': 'high_priority'}
+    assert router('t', (), {}, options, task=task) == 'backend.high'
+    options = {'routing_key': 'high_priority', 'exchange': 'other'}
+    assert router('t', (), {}, options, task=task) == 'other.high'
+    options = {'routing_key': 'unknown'}
+    assert router('t', (), {}, options, task=task) == 'backend.middle'
+    assert router.hits == 2
+    assert router.misses == 1
+
+    # Routing table is rebuilt after changing of queues
+    exchange = Exchange('backend.default', type='direct')
+    celery.conf.task_queues.append(Queue('backend.low', exchange, routing_key='low'))
+    options = {'routing_key': 'low'}
+    assert router('t', (), {}, options, task=task) == 'backend.low'
+    assert router.hits == 3
+
+    # Replacing of a queue in place requires explicit invalidation
+    celery.conf.task_queues[0] = Queue('backend.top', exchange, routing_key='top')
+    options = {'routing_key': 'top'}
+    assert router('t', (), {}, options, task=task) == 'backend.middle'
+    router.invalidate(celery)
+    assert router('t', (), {}, options, task=task) == 'backend.top'
+    options = {'routing_key': 'high_priority'}
+    assert router('t', (), {}, options, task=task) == 'backend.middle'
+
+
+def test_router_stats():
+    celery = create_celery()
+    sink = AggregatingStatsSink()
+    celery.pyramid_registry = {'pcelery_stats_sink': sink}
+    task = SimpleNamespace(app=celery)
+    router = RouterByRoutingKey(default_queue_name='backend.low')
+    options = {'routing_key': 'high_priority'}
+    assert router('t', (), {}, options, task=task) == 'backend.high'
+    assert sink.get('pcelery.publish.route', task='t', route='').count == 1
+
+
+def test_sharded_router():
+    def reindex(tenant_id, obj_id=None):
+        pass
+
+    task = SimpleNamespace(run=reindex)
+    router = ShardedRouter(
+        'backend.shard',
+        shards=4,
+        shard_keys={
+            'reindex': 'tenant_id',
+            'by_position': 1,
+            'by_callable': lambda args, kwargs: kwargs['path'].split('/')[0],
+        },
+    )
+    queues = router.create_queues(None)
+    assert [q.name for q in queues] == [f'backend.shard.{i}' for i in range(4)]
+    assert {q.exchange.name for q in queues} == {'backend.shard'}
+
+    queue_name = router.get_queue_name(42)
+    assert router('reindex', (42,), {}, {}, task=task) == queue_name
+    assert router('reindex', (), {'tenant_id': 42}, {}, task=task) == queue_name
+    assert router('by_position', (1, 42), {}, {}) == queue_name
+    assert router('by_callable', (), {'path': '42/a'}, {}) == queue_name
+    assert router('reindex', (), {'obj_id': 1}, {}, task=task) is None
+    assert router('other', (42,), {}, {}, task=task) is None
+
+    # Keys are spread over all queues
+    counts = {}
+    for key in range(1000):
+        queue_name = router.get_queue_name(key)
+        counts[queue_name] = counts.get(queue_name, 0) + 1
+    assert len(counts) == 4
+    assert min(counts.values()) > 150
+
+    # Adding of a shard moves only keys to the new queue
+    bigger = ShardedRouter('backend.shard', shards=5, shard_keys={})
+    moved = 0
+    for key in range(1000):
+        new_queue = bigger.get_queue_name(key)
+        if new_queue != router.get_queue_name(key):
+            assert new_queue == 'backend.shard.4'
+            moved += 1
+    assert 100 < moved < 300
@@ -4,22 +4,61 @@
 :Date: 29.08.2017
 """
 
+import asyncio
+import gc
 import sys
+import threading
+import weakref
 from contextlib import contextmanager
 from io import StringIO
+from datetime import timedelta
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Optional, Type
 from pyramid import testing
 
 import pytest
-from celery import Task
-from celery.exceptions import Retry
+from celery import Celery, Task
+from celery.exceptions import Reject, Retry
+from celery.signals import task_failure, task_postrun, task_prerun, task_success
+from celery.worker.state import revoked as revoked_tasks
+from kombu import Exchange, Queue
+from kombu.exceptions import ContentDisallowed, EncodeError
+from kombu.transport.virtual import Message
+from kombu.transport.memory import Channel
+from pyramid.httpexceptions import (
+    HTTPException,
+    HTTPFound,
+    default_exceptionresponse_view,
+)
 from pyramid.request import Request
-from pyramid.threadlocal import get_current_request
+from pyramid.response import Response
+from pyramid.threadlocal import get_current_registry, get_current_request, manager
+from pyramid.traversal import DefaultRootFactory
 
 from .. import task, add_celery_tasks_alt_name_factory, get_celery
+from .. import utils as pcelery_utils
+from ..outbox import OUTBOX_ONLY_ON_SUCCESS_KEY
+from .. import publisher as publisher_module
+from ..publisher import AsyncPublisher, PublisherStopped, get_async_publisher
+from ..stats import AggregatingStatsSink
+from ..base_task import (
+    RequestEnvFilter,
+    deserialize_request,
+    get_request_builder,
+    get_request_extra,
+    serialize_request,
+)
 from ..commands import pcelery
-from ..testing import TasksQueue
+from ..batches import BatchTaskMixin, get_batch_task_class
+from ..routers import RouterByRoutingKey
+from ..testing import (
+    IndexedQueue,
+    TasksBroker,
+    TasksQueue,
+    TasksScheduler,
+    get_indexed_queue,
+)
 
 
 @task(bind=True, max_retries=100)
@@ -78,11 +117,12 @@ def test_cli_command():
     assert std_out.getvalue().strip() == '5.6.2 (recovery)'
 
 
-def test_tasks_queue_retry(pyramid_request):
+@pytest.mark.parametrize('fast_execution', [True, False])
+def test_tasks_queue_retry(pyramid_request, fast_execution):
     cur_request_id = id(get_current_request())
     registry = pyramid_request.registry
 
-    tasks_queue = TasksQueue(pyramid_request.registry)
+    tasks_queue = TasksQueue(pyramid_request.registry, fast_execution=fast_execution)
     first_task.delay(cur_request_id, retry=1)
     assert tasks_queue.get_count_by_name(first_task.name) == 1
     with pytest.raises(Retry):
@@ -142,6 +182,8 @@ def test_tasks_order(pyramid_request):
 def alt_task_name(task_class: Type[Task]) -> Optional[str]:
     if task_class.name.endswith('.first_task'):
         return 'renamed.first_task'
+    if task_class.name.endswith('.no_request_task'):
+        return 'renamed.no_request_task'
     return None
 
 
@@ -155,3 +197,942 @@ def test_alt_task_name():
         config.scan()
         celery = get_celery(config.registry)
         assert celery.tasks['renamed.first_task'].name == first_task.name
+
+
+def test_request_extra_cache(pyramid_request):
+    extra = get_request_extra(pyramid_request)
+    assert extra['http_request']['REQUEST_URL'] == 'http://localhost'
+    assert get_request_extra(pyramid_request) is extra
+
+    pyramid_request.environ['HTTP_X_CUSTOM'] = 'value'
+    new_extra = get_request_extra(pyramid_request)
+    assert new_extra is not extra
+    assert new_extra['http_request']['REQUEST_ENV']['HTTP_X_CUSTOM'] == 'value'
+
+    # Values are changed without changing of environ size
+    environ_size = len(pyramid_request.environ)
+    pyramid_request.environ['HTTP_HOST'] = 'example.com'
+    pyramid_request.environ['PATH_INFO'] = '/b'
+    assert len(pyramid_request.environ) == environ_size
+    extra = get_request_extra(pyramid_request)
+    assert extra is not new_extra
+    assert extra['http_request']['REQUEST_URL'] == pyramid_request.url
+    assert extra['http_request']['REQUEST_URL'] == 'http://example.com/b'
+    assert get_request_extra(pyramid_request) is extra
+
+
+def test_request_env_filter():
+    request = Request.blank('http://localhost')
+    request.environ.update(
+        HTTP_COOKIE='c' * 100,
+        HTTP_ACCEPT='text/html',
+        HTTP_X_FORWARDED_FOR='127.0.0.1',
+    )
+    env_filter = RequestEnvFilter(deny={'HTTP_X_FORWARDED_FOR'}, max_value_size=50)
+    data = serialize_request(request, env_filter)
+    env = data['REQUEST_ENV']
+    assert env['HTTP_ACCEPT'] == 'text/html'
+    assert 'HTTP_X_FORWARDED_FOR' not in env
+    assert 'HTTP_COOKIE' not in env
+    assert env_filter.dropped == {'HTTP_COOKIE': 1}
+
+    env_filter = RequestEnvFilter(allow={'HTTP_ACCEPT', 'HTTP_HOST'})
+    env = serialize_request(request, env_filter)['REQUEST_ENV']
+    assert set(env) == {'HTTP_ACCEPT', 'HTTP_HOST'}
+
+    env_filter = RequestEnvFilter(predicate=lambda key, value: key != 'HTTP_ACCEPT')
+    env = serialize_request(request, env_filter)['REQUEST_ENV']
+    assert 'HTTP_ACCEPT' not in env
+    assert 'HTTP_COOKIE' in env
+
+
+def test_request_env_config():
+    request = Request.blank('http://localhost')
+    with testing.testConfig(request=request) as config:
+        config.include('pcelery')
+        config.set_celery_config(
+            {'testing': True, 'request_env': {'allow': ['HTTP_HOST']}}
+        )
+        config.scan()
+        registry = config.registry
+        get_celery(registry)
+        request.registry = registry
+        env = get_request_extra(request)['http_request']['REQUEST_ENV']
+        assert env == {'HTTP_HOST': 'localhost:80'}
+
+
+@task(bind=True)
+def lazy_request_task(self):
+    info = manager.get()
+    registry = get_current_registry()
+    registry.lazy_request_states = ['request' in info]
+    request = get_current_request()
+    registry.lazy_request_states.append('request' in info)
+    assert request is self.pyramid_request
+    assert request.registry is registry
+
+
+def test_lazy_pyramid_request(pyramid_request):
+    registry = pyramid_request.registry
+    tasks_queue = TasksQueue(registry)
+    lazy_request_task.delay()
+    tasks_queue.run_all_tasks()
+    assert registry.lazy_request_states == [False, True]
+
+
+def test_deserialize_request(pyramid_request):
+    registry = pyramid_request.registry
+    data = serialize_request(pyramid_request)
+    request1 = deserialize_request(data, registry)
+    request2 = deserialize_request(data, registry)
+    assert request1 is not request2
+    assert request1.environ is not request2.environ
+    assert request1.environ['wsgi.input'] is not request2.environ['wsgi.input']
+    assert request1.url == request2.url == pyramid_request.url
+    assert request1.registry is registry
+
+    builder = get_request_builder(registry)
+    cache_info = builder._get_environ_template.cache_info()
+    assert cache_info.hits == 1
+    assert cache_info.misses == 1
+
+
+@task(bind=True, propagate_request=False)
+def no_request_task(self):
+    request = self.pyramid_request
+    request.registry.no_request_task_env = request.environ
+
+
+def test_task_without_request_propagation(pyramid_request):
+    registry = pyramid_request.registry
+    assert registry['pcelery_request_propagation'][no_request_task.name] is False
+    assert registry['pcelery_request_propagation'][first_task.name] is True
+
+    pyramid_request.environ['HTTP_X_CUSTOM'] = 'value'
+    tasks_queue = TasksQueue(registry)
+    no_request_task.delay()
+    first_task.delay(0)
+    _, _, embed = tasks_queue[0].decode()
+    assert 'pcelery.extra' not in embed
+    _, _, embed = tasks_queue[1].decode()
+    assert 'pcelery.extra' in embed
+
+    tasks_queue.run_oldest_task()
+    assert 'HTTP_X_CUSTOM' not in registry.no_request_task_env
+
+
+def test_delay_many(pyramid_request):
+    registry = pyramid_request.registry
+    registry.tasks_order = []
+    tasks_queue = TasksQueue(registry)
+    results = order_task_1.delay_many([(), (), ()])
+    assert len(results) == 3
+    assert len({r.id for r in results}) == 3
+    assert tasks_queue.get_count_by_name(order_task_1.name) == 3
+
+    extras = [tasks_queue[i].decode()[2]['pcelery.extra'] for i in range(3)]
+    assert extras[0] == extras[1] == extras[2]
+
+    tasks_queue.run_all_tasks()
+    assert registry.tasks_order == [1, 1, 1]
+
+
+def test_tasks_outbox(pyramid_request):
+    registry = pyramid_request.registry
+    registry.tasks_order = []
+    tasks_queue = TasksQueue(registry)
+    assert order_task_1.delay_after_response() is True
+    assert order_task_2.delay_after_response() is True
+    assert order_task_1.delay_after_response() is False
+    assert first_task.delay_after_response(1) is True
+    assert first_task.delay_after_response(2) is True
+    assert first_task.delay_after_response(1) is False
+    assert len(pyramid_request.pcelery_outbox) == 4
+    assert len(tasks_queue) == 0
+
+    pyramid_request._process_finished_callbacks()
+    assert len(tasks_queue) == 4
+    assert tasks_queue.get_count_by_name(first_task.name) == 2
+    tasks_queue.clear()
+
+    # Outbox is dropped if the request has not been finished successfully
+    outbox = pyramid_request.pcelery_outbox
+    outbox.only_on_success = True
+    order_task_1.delay_after_response()
+    pyramid_request._process_response_callbacks(Response(status=500))
+    pyramid_request._process_finished_callbacks()
+    assert len(tasks_queue) == 0
+
+    order_task_1.delay_after_response()
+    pyramid_request._process_response_callbacks(Response())
+    pyramid_request._process_finished_callbacks()
+    assert len(tasks_queue) == 1
+    tasks_queue.clear()
+
+    # Outbox is published if there was neither response nor exception
+    order_task_1.delay_after_response()
+    pyramid_request._process_finished_callbacks()
+    assert len(tasks_queue) == 1
+    tasks_queue.clear()
+
+    # Exception without response
+    order_task_1.delay_after_response()
+    pyramid_request.exception = ValueError()
+    pyramid_request._process_finished_callbacks()
+    assert len(tasks_queue) == 0
+
+    # Redirect without response
+    order_task_1.delay_after_response()
+    pyramid_request.exception = HTTPFound('/')
+    pyramid_request._process_finished_callbacks()
+    assert len(tasks_queue) == 1
+
+
+def _outbox_view(request):
+    order_task_1.delay_after_response()
+    if request.path == '/redirect':
+        raise HTTPFound('/')
+    if request.path == '/error':
+        raise ValueError()
+    return Response()
+
+
+def _error_view(exc, request):
+    return Response(status=500)
+
+
+def test_tasks_outbox_of_views(app_config):
+    registry = app_config.registry
+    registry[OUTBOX_ONLY_ON_SUCCESS_KEY] = True
+    app_config.add_route('outbox', '/*path')
+    app_config.add_view(_outbox_view, route_name='outbox')
+    app_config.add_view(_error_view, context=ValueError)
+    app_config.add_view(default_exceptionresponse_view, context=HTTPException)
+    app = app_config.make_wsgi_app()
+    tasks_queue = TasksQueue(registry)
+
+    # Redirect raised by view is a successful response
+    response = Request.blank('/redirect').get_response(app)
+    assert response.status_code == 302
+    assert len(tasks_queue) == 1
+    tasks_queue.clear()
+
+    response = Request.blank('/error').get_response(app)
+    assert response.status_code == 500
+    assert len(tasks_queue) == 0
+
+    response = Request.blank('/').get_response(app)
+    assert response.status_code == 200
+    assert len(tasks_queue) == 1
+
+
+def test_tasks_outbox_async(pyramid_request):
+    registry = pyramid_request.registry
+    tasks_queue = TasksQueue(registry)
+    outbox = pyramid_request.pcelery_outbox
+    outbox.publisher = get_async_publisher(registry)
+    pyramid_request.environ['HTTP_X_CUSTOM'] = 'value'
+    order_task_1.delay_after_response()
+    order_task_2.delay_after_response()
+    future = outbox.flush_async()
+    assert len(future.result(timeout=5)) == 2
+    assert len(tasks_queue) == 2
+    env = tasks_queue[0].decode()[2]['pcelery.extra']['http_request']['REQUEST_ENV']
+    assert env['HTTP_X_CUSTOM'] == 'value'
+    assert outbox.flush_async() is None
+    outbox.publisher.stop()
+
+
+def test_celery_warmup(monkeypatch):
+    warmed_up = []
+
+    def warm_up_celery(celery, **kwargs):
+        warmed_up.append(kwargs)
+        original_warm_up_celery(celery, **kwargs)
+
+    original_warm_up_celery = pcelery_utils.warm_up_celery
+    monkeypatch.setattr(pcelery_utils, 'warm_up_celery', warm_up_celery)
+    Channel.queues.pop('pcelery.default', None)
+    request = Request.blank('http://localhost')
+    with testing.testConfig(request=request) as config:
+        config.include('pcelery')
+        config.set_celery_config({'testing': True, 'warmup': {'connections': 2}})
+        get_celery(config.registry)
+        assert warmed_up == [{'connections': 2}]
+        assert 'pcelery.default' in Channel.queues
+
+    # Warming up only by post-fork hook of web server
+    warmed_up.clear()
+    with testing.testConfig(request=request) as config:
+        config.include('pcelery')
+        config.set_celery_config(
+            {'testing': True, 'warmup': {'connections': 2, 'after_fork': True}}
+        )
+        get_celery(config.registry)
+        assert warmed_up == []
+        pcelery_utils.warm_up_after_fork(config.registry)
+        assert warmed_up == [{'connections': 2}]
+
+    # Nothing to warm up without the key
+    with testing.testConfig(request=request) as config:
+        config.include('pcelery')
+        config.set_celery_config({'testing': True})
+        pcelery_utils.warm_up_after_fork(config.registry)
+        assert len(warmed_up) == 1
+
+
+def test_task_proxy_fast_attributes(app_config):
+    celery_task = first_task.celery_task
+    assert first_task.name == celery_task.name
+    for item in first_task.fast_attributes:
+        assert item in first_task.__dict__
+        assert getattr(first_task, item) == getattr(celery_task, item)
+    assert first_task.max_retries == 100
+
+
+@task(name='custom.name')
+def custom_name_task():
+    pass
+
+
+def test_lazy_tasks():
+    request = Request.blank('http://localhost')
+    with testing.testConfig(request=request) as config:
+        config.include('pcelery')
+        config.set_celery_config({'testing': True, 'lazy_tasks': True})
+        add_celery_tasks_alt_name_factory(config, alt_task_name)
+        config.scan()
+        config.commit()
+        celery = get_celery(config.registry)
+        tasks = celery.tasks
+        assert first_task.name in tasks.pending
+        assert order_task_1.name in tasks.pending
+        assert order_task_1.celery_task is None
+
+        # Task is created on first access through proxy
+        signature = order_task_1.s()
+        assert order_task_1.name not in tasks.pending
+        assert order_task_1.celery_task is tasks[order_task_1.name]
+        assert signature.task == order_task_1.name
+
+        # or on lookup by name
+        assert tasks.get(order_task_2.name) is order_task_2.celery_task
+        assert order_task_2.name not in tasks.pending
+
+        # Name of proxy is the name of the pending task
+        assert custom_name_task.celery_task is None
+        assert custom_name_task.name == 'custom.name'
+        assert custom_name_task.name in tasks.pending
+        assert custom_name_task.s().task == 'custom.name'
+
+        # Request is not embedded into messages published by alternative name
+        # of pending task
+        propagation = config.registry['pcelery_request_propagation']
+        assert propagation['renamed.no_request_task'] is False
+        assert propagation['renamed.first_task'] is True
+        tasks_queue = TasksQueue(config.registry)
+        celery.send_task('renamed.no_request_task')
+        _, _, embed = tasks_queue[0].decode()
+        assert 'pcelery.extra' not in embed
+        assert no_request_task.name in tasks.pending
+
+        # Lookup of unknown name creates all pending tasks
+        assert tasks['renamed.first_task'] is first_task.celery_task
+        assert tasks['renamed.no_request_task'] is no_request_task.celery_task
+        assert not tasks.pending
+
+
+def test_task_phases_stats(pyramid_request):
+    registry = pyramid_request.registry
+    registry['pcelery_stats_sink'] = sink = AggregatingStatsSink()
+    registry.tasks_order = []
+    tasks_queue = TasksQueue(registry)
+    order_task_1.delay()
+    order_task_1.delay()
+    tasks_queue.run_all_tasks()
+    assert registry.tasks_order == [1, 1]
+    phases = [
+        'context_begin',
+        'deserialize_request',
+        'root_factory',
+        'run',
+        'finished_callbacks',
+        'context_end',
+    ]
+    for phase in phases:
+        aggregate = sink.get(f'pcelery.task.{phase}', task=order_task_1.name)
+        assert aggregate.count == 2
+        assert aggregate.min >= 0
+
+
+def test_publish_stats(pyramid_request):
+    registry = pyramid_request.registry
+    registry['pcelery_stats_sink'] = sink = AggregatingStatsSink()
+    pyramid_request.matched_route = SimpleNamespace(name='home')
+    TasksQueue(registry)
+    order_task_1.delay()
+    order_task_1.delay()
+    no_request_task.delay()
+
+    tags = {'task': order_task_1.name, 'route': 'home'}
+    assert sink.get('pcelery.publish.add_params', **tags).count == 2
+    envelope_size = sink.get('pcelery.publish.envelope_size', **tags)
+    assert envelope_size.count == 2
+    assert envelope_size.min > 0
+    assert sink.get('pcelery.publish.serialize_request', route='home').count == 1
+    messages = sink.get('pcelery.publish.messages', queue='pcelery.default', **tags)
+    assert messages.total == 2
+
+    # Route is known even if request is not embedded into the message
+    tags = {'task': no_request_task.name, 'route': 'home'}
+    assert sink.get('pcelery.publish.add_params', **tags).count == 1
+    assert sink.get('pcelery.publish.envelope_size', **tags) is None
+
+    # Routing key is not used as name of queue
+    order_task_2.apply_async(
+        exchange='pcelery.default', routing_key='pcelery.default', declare=[]
+    )
+    tags = {'task': order_task_2.name, 'route': 'home'}
+    assert sink.get('pcelery.publish.messages', queue='', **tags).total == 1
+
+    # Environ items dropped by size limits of filter
+    registry['pcelery_request_env_filter'] = RequestEnvFilter(max_value_size=50)
+    pyramid_request.environ['HTTP_COOKIE'] = 'c' * 100
+    order_task_1.delay()
+    order_task_1.delay()
+    dropped = sink.get('pcelery.publish.env_dropped', route='home', key='HTTP_COOKIE')
+    assert dropped.total == 1
+
+
+def test_delay_async(pyramid_request):
+    registry = pyramid_request.registry
+    registry.tasks_order = []
+    tasks_queue = TasksQueue(registry)
+    pyramid_request.environ['HTTP_X_CUSTOM'] = 'before'
+
+    async def publish():
+        coroutine = order_task_1.delay_async()
+        # Envelope is captured at the call time
+        pyramid_request.environ['HTTP_X_CUSTOM'] = 'after'
+        pyramid_request.environ['HTTP_X_OTHER'] = 'value'
+        first = await coroutine
+        second = await first_task.apply_async_async((id(pyramid_request),))
+        return first, second
+
+    first, second = asyncio.run(publish())
+    assert first.id != second.id
+    assert registry['pcelery_async_publisher']._thread.name == 'pcelery-publisher'
+    assert len(tasks_queue) == 2
+    assert tasks_queue.get_count_by_name(first_task.name) == 1
+    env = tasks_queue[0].decode()[2]['pcelery.extra']['http_request']['REQUEST_ENV']
+    assert env['HTTP_X_CUSTOM'] == 'before'
+
+    tasks_queue.run_all_tasks()
+    assert registry.tasks_order == [1]
+
+    registry['pcelery_async_publisher'].stop()
+    assert registry['pcelery_async_publisher']._thread is None
+
+
+def test_async_publisher_overflow(monkeypatch):
+    registered = []
+    monkeypatch.setattr(
+        publisher_module.atexit, 'register', lambda *args: registered.append(args)
+    )
+    publisher = AsyncPublisher(maxsize=1)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    publisher.submit(block)
+    started.wait(5)
+    # Messages over the size of queue are queued without waiting and awaiting
+    futures = [publisher.submit(calls.append, i) for i in range(5)]
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+    assert calls == [0, 1, 2, 3, 4]
+    publisher.stop()
+
+    # Restart of the thread doesn't register exit handler again
+    started.clear()
+    release.clear()
+    publisher.submit(block)
+    started.wait(5)
+    queued = publisher.submit(calls.append, 5)
+    waiting = publisher.submit(calls.append, 6)
+    threading.Timer(0.2, release.set).start()
+    publisher.stop()
+    assert queued.result(timeout=5) is None
+    with pytest.raises(PublisherStopped):
+        waiting.result(timeout=5)
+    assert calls[-1] == 5
+    assert len(registered) == 1
+
+
+def test_indexed_tasks_queue(pyramid_request):
+    registry = pyramid_request.registry
+    registry.tasks_order = []
+    tasks_queue = TasksQueue(registry, disabled_tasks={order_task_2.name})
+    for _ in range(3):
+        order_task_1.delay()
+        order_task_2.delay()
+        order_task_master.delay()
+    assert isinstance(tasks_queue.queue, IndexedQueue)
+    assert len(tasks_queue.queue) == 9
+    assert len(tasks_queue) == 6
+    assert tasks_queue.get_count_by_name(order_task_1.name) == 3
+    assert tasks_queue.get_count_by_name(order_task_2.name) == 0
+    assert order_task_master.name in tasks_queue
+    assert order_task_2.name not in tasks_queue
+    assert tasks_queue[1].decode()  # Cached view without disabled tasks
+    assert tasks_queue[1].headers['task'] == order_task_master.name
+    assert tasks_queue[-1].headers['task'] == order_task_master.name
+
+    tasks_queue.run_last_task(order_task_1.name)
+    tasks_queue.run_oldest_task(order_task_master.name)
+    assert registry.tasks_order == [1, 0]
+    assert tasks_queue.get_count_by_name(order_task_1.name) == 3
+    assert tasks_queue.get_count_by_name(order_task_master.name) == 2
+    assert tasks_queue[-1].headers['task'] == order_task_1.name
+
+    tasks_queue.disabled_tasks.clear()
+    assert len(tasks_queue) == 9
+    assert tasks_queue[-1].headers['task'] == order_task_2.name
+    tasks_queue.run_tasks_by_name(order_task_2.name)
+    assert tasks_queue.get_count_by_name(order_task_2.name) == 0
+    tasks_queue.run_all_tasks()
+    assert len(tasks_queue) == 0
+
+
+@task(bind=True)
+def ordered_value_task(self, value):
+    self.pyramid_registry.tasks_order.append(value)
+
+
+@task()
+def failing_task(value):
+    raise ValueError(value)
+
+
+def test_run_all_tasks_in_parallel(pyramid_request):
+    registry = pyramid_request.registry
+    registry.tasks_order = []
+    tasks_queue = TasksQueue(registry)
+    for i in range(100, 120):
+        ordered_value_task.delay(i)
+        order_task_master.delay()
+    errors = tasks_queue.run_all_tasks(concurrency=4)
+    assert errors == []
+    assert len(tasks_queue) == 0
+    values = [v for v in registry.tasks_order if v >= 100]
+    assert values == list(range(100, 120))
+    # Tasks published by tasks are executed in the next rounds
+    assert registry.tasks_order.count(0) == 20
+    assert registry.tasks_order.count(1) == 20
+    assert registry.tasks_order.count(2) == 20
+
+    registry.tasks_order.clear()
+    failing_task.delay(1)
+    ordered_value_task.delay(10)
+    failing_task.delay(2)
+    errors = tasks_queue.run_all_tasks(concurrency=2, collect_errors=True)
+    assert sorted(e.args[0] for e in errors) == [1, 2]
+    assert registry.tasks_order == [10]
+
+    failing_task.delay(3)
+    order_task_master.delay()
+    with pytest.raises(ValueError):
+        tasks_queue.run_all_tasks(concurrency=2)
+    assert tasks_queue.get_count_by_name(order_task_1.name) == 1
+
+    # Sequential running returns list too
+    assert tasks_queue.run_all_tasks() == []
+
+
+def test_tasks_queue_fast_execution(pyramid_request):
+    registry = pyramid_request.registry
+    pyramid_request.environ['HTTP_X_CUSTOM'] = 'value'
+    tasks_queue = TasksQueue(registry)
+    no_request_task.delay()
+    first_task.delay(id(pyramid_request))
+    tasks_queue.run_all_tasks()
+    assert len(tasks_queue) == 0
+
+    failing_task.delay(1)
+    payload = tasks_queue.queue[0]
+    exc_info = tasks_queue.execute_payload(payload)
+    assert isinstance(exc_info.exception, ValueError)
+    with pytest.raises(ValueError):
+        tasks_queue.run_oldest_task()
+
+    # Content type of the message must be accepted by Celery app
+    first_task.apply_async((1,), serializer='pickle')
+    with pytest.raises(ContentDisallowed):
+        tasks_queue.run_oldest_task()
+
+    # Arguments pass through the serializer
+    with pytest.raises(EncodeError):
+        ordered_value_task.delay(object())
+    registry.tasks_order = []
+    ordered_value_task.delay((1, 2))
+    tasks_queue.run_all_tasks()
+    assert registry.tasks_order == [[1, 2]]
+
+
+@pytest.mark.parametrize('fast_execution', [True, False])
+def test_tasks_queue_skips_revoked_tasks(pyramid_request, fast_execution):
+    registry = pyramid_request.registry
+    registry.tasks_order = []
+    tasks_queue = TasksQueue(registry, fast_execution=fast_execution)
+
+    ordered_value_task.apply_async((1,), expires=-60)
+    assert tasks_queue.run_oldest_task() is None
+    assert registry.tasks_order == []
+
+    result = ordered_value_task.delay(2)
+    revoked_tasks.add(result.id)
+    try:
+        assert tasks_queue.run_oldest_task() is None
+    finally:
+        revoked_tasks.discard(result.id)
+    assert registry.tasks_order == []
+
+    ordered_value_task.apply_async((3,), expires=60)
+    tasks_queue.run_oldest_task()
+    assert registry.tasks_order == [3]
+
+
+def test_tasks_scheduler(pyramid_request):
+    registry = pyramid_request.registry
+    registry.tasks_order = []
+    registry.first_task_runs = 0
+    tasks_queue = TasksQueue(registry)
+    with TasksScheduler(tasks_queue) as scheduler:
+        start = scheduler.now
+        assert registry.celery.now() == start
+        ordered_value_task.apply_async((3,), countdown=30)
+        ordered_value_task.apply_async((2,), countdown=10)
+        ordered_value_task.delay(1)
+        first_task.delay(1, retry=5, dont_retry_after=3)
+        assert len(scheduler) == 4
+        assert scheduler.next_eta == start
+
+        # first_task is retried with countdown=5
+        assert scheduler.run_due_tasks() == 2
+        assert registry.tasks_order == [1]
+        assert registry.first_task_runs == 1
+        assert scheduler.next_eta == start + timedelta(seconds=5)
+
+        assert scheduler.advance(4) == 0
+        assert scheduler.advance(1) == 1
+        assert registry.first_task_runs == 2
+        assert scheduler.advance(10) == 2
+        assert registry.tasks_order == [1, 2]
+        assert registry.first_task_runs == 3
+
+        assert scheduler.run_until_empty() == 2
+        assert registry.tasks_order == [1, 2, 3]
+        assert scheduler.now == start + timedelta(seconds=30)
+        assert len(scheduler) == 0
+
+    assert registry.celery.now() > start
+
+
+def create_low_queues(registry):
+    exchange = Exchange('backend.default', type='direct')
+    return [Queue('backend.low', exchange, routing_key='low_priority')]
+
+
+def test_tasks_broker():
+    exchange = Exchange('backend.default', type='direct')
+    celery_config = {
+        'testing': True,
+        'keep_queues': True,
+        'task_default_exchange': 'backend.default',
+        'task_default_queue': 'backend.middle',
+        'task_queues': [
+            Queue('backend.high', exchange, routing_key='high_priority'),
+            Queue('backend.middle', exchange, routing_key='middle_priority'),
+        ],
+        'task_routes': [RouterByRoutingKey(default_queue_name='backend.middle')],
+    }
+    request = Request.blank('http://localhost')
+    with testing.testConfig(request=request) as config:
+        config.include('pcelery')
+        config.add_celery_queues_factory(create_low_queues)
+        config.set_celery_config(celery_config)
+        config.scan()
+        config.commit()
+        registry = config.registry
+        registry.tasks_order = []
+        request.registry = registry
+        broker = TasksBroker(registry)
+        # Queues of other apps are not visible
+        get_indexed_queue('other.app.queue')
+        assert 'other.app.queue' in Channel.queues
+        assert 'other.app.queue' not in broker.queue_names
+
+        ordered_value_task.apply_async((1,), routing_key='low_priority')
+        ordered_value_task.apply_async((2,), routing_key='high_priority')
+        ordered_value_task.delay(3)
+        ordered_value_task.apply_async((4,), routing_key='high_priority')
+        counts = broker.get_counts()
+        assert counts['backend.high'] == 2
+        assert counts['backend.middle'] == 1
+        assert counts['backend.low'] == 1
+        assert len(broker) == 4
+        assert broker.get_count_by_name(ordered_value_task.name) == 4
+        assert broker['backend.high'].get_count_by_name(ordered_value_task.name) == 2
+        assert broker.get_count_by_routing_key('high_priority') == 2
+        messages = broker.get_messages_by_routing_key('high_priority')
+        assert [m.decode()[0] for m in messages] == [[2], [4]]
+
+        broker.run_all_tasks()
+        assert registry.tasks_order == [1, 2, 3, 4]
+        assert len(broker) == 0
+
+
+@task(bind=True, batch_size=2, batch_timeout=5, acks_late=True)
+def batch_task(self, items):
+    request = self.pyramid_request
+    registry = request.registry
+    values = [item.args[0] for item in items]
+    if 'fail' in values:
+        raise ValueError(values)
+    if 'reject' in values:
+        raise Reject(values, requeue=True)
+    registry.batches.append((values, request.environ.get('HTTP_X_CUSTOM')))
+
+
+def test_batch_task(pyramid_request):
+    registry = pyramid_request.registry
+    registry.batches = []
+    tasks_queue = TasksQueue(registry)
+    assert isinstance(batch_task.celery_task, BatchTaskMixin)
+
+    # Without batch strategy every message is a batch with one item
+    batch_task.delay(1)
+    batch_task.delay(2)
+    tasks_queue.run_all_tasks()
+    assert registry.batches == [([1], None), ([2], None)]
+
+    registry.batches.clear()
+    pyramid_request.environ['HTTP_X_CUSTOM'] = 'value'
+    for value in (1, 2, 'fail', 3, 4):
+        batch_task.delay(value)
+    channel = tasks_queue._channel
+    messages = [Message(tasks_queue.queue.popleft(), channel) for _ in range(5)]
+
+    consumer = FakeConsumer()
+    handler = batch_task.celery_task.start_strategy(registry.celery, consumer)
+    acks = []
+    rejects = []
+    for message in messages:
+        handler(
+            message,
+            None,
+            lambda *args, m=message: acks.append(m),
+            lambda *args, m=message, **kwargs: rejects.append(m),
+            [],
+        )
+    assert registry.batches == [([1, 2], 'value')]
+    assert acks == messages[:2]
+    assert rejects == messages[2:4]
+    # The last message waits for timeout
+    assert consumer.prefetch == 1
+    assert len(consumer.timers) == 1
+
+    consumer.timers[0]()
+    assert registry.batches == [([1, 2], 'value'), ([4], 'value')]
+    assert acks == messages[:2] + messages[4:]
+    assert consumer.prefetch == 0
+
+    # Batches are executed by the tracer of the task
+    sent_signals = []
+
+    def on_signal(sender=None, signal=None, task_id=None, **kwargs):
+        sent_signals.append((signal.name, task_id))
+
+    receivers = (task_prerun, task_postrun, task_success, task_failure)
+    for signal in receivers:
+        signal.connect(on_signal, sender=batch_task.celery_task)
+    try:
+        results = [batch_task.delay(value) for value in (5, 'reject')]
+        messages = [Message(tasks_queue.queue.popleft(), channel) for _ in range(2)]
+        requeues = []
+        for message in messages:
+            handler(
+                message,
+                None,
+                lambda *args: acks.append(args),
+                lambda *args: requeues.append(args[-1]),
+                [],
+            )
+    finally:
+        for signal in receivers:
+            signal.disconnect(on_signal, sender=batch_task.celery_task)
+    assert requeues == [True, True]
+    batch_id = results[0].id
+    assert [name for name, _ in sent_signals] == ['task_prerun', 'task_postrun']
+    assert {task_id for _, task_id in sent_signals} == {batch_id}
+
+    sent_signals.clear()
+    task_failure.connect(on_signal, sender=batch_task.celery_task)
+    try:
+        batch_task.delay('fail')
+        batch_task.delay(6)
+        messages = [Message(tasks_queue.queue.popleft(), channel) for _ in range(2)]
+        for message in messages:
+            handler(message, None, lambda *args: None, lambda *args: None, [])
+    finally:
+        task_failure.disconnect(on_signal, sender=batch_task.celery_task)
+    assert [name for name, _ in sent_signals] == ['task_failure']
+
+
+def test_batch_task_classes_are_released_with_app():
+    celery = Celery('test', broker='memory://', set_as_current=False)
+    task_class = weakref.ref(get_batch_task_class(celery, celery.Task))
+    assert get_batch_task_class(celery, celery.Task) is task_class()
+    del celery
+    gc.collect()
+    assert task_class() is None
+
+
+class FakeConsumer:
+    """Minimal consumer of worker that is used by strategies of tasks."""
+
+    def __init__(self):
+        self.hostname = 'worker'
+        self.connection_errors = ()
+        self.controller = SimpleNamespace(state=SimpleNamespace(revoked=set()))
+        self.timer = SimpleNamespace(call_after=self.call_after)
+        self.qos = SimpleNamespace(
+            increment_eventually=self.increment,
+            decrement_eventually=self.decrement,
+        )
+        self.pool = SimpleNamespace(apply_async=self.apply_async)
+        self.timers = []
+        self.prefetch = 0
+
+    def call_after(self, seconds, fun):
+        self.timers.append(fun)
+        return SimpleNamespace(cancel=lambda: self.timers.remove(fun))
+
+    def increment(self):
+        self.prefetch += 1
+
+    def decrement(self):
+        self.prefetch -= 1
+
+    @staticmethod
+    def apply_async(target, args, callback, error_callback):
+        callback(target(*args))
+
+
+@task(bind=True, reuse_pyramid_request=True)
+def reuse_request_task(self, value):
+    request = self.pyramid_request
+    registry = request.registry
+    registry.reused_requests.append(
+        (id(request), id(request.root), getattr(request, 'task_value', None))
+    )
+    request.task_value = value
+    request.environ['HTTP_X_TASK'] = value
+
+
+def test_reuse_pyramid_request(pyramid_request):
+    registry = pyramid_request.registry
+    registry.reused_requests = []
+    registry['pcelery_stats_sink'] = sink = AggregatingStatsSink()
+    tasks_queue = TasksQueue(registry)
+    for value in ('1', '2', '3'):
+        reuse_request_task.delay(value)
+    tasks_queue.run_all_tasks()
+    requests = registry.reused_requests
+    assert len({r[:2] for r in requests}) == 1
+    # Attributes set by the previous task are dropped
+    assert [r[2] for r in requests] == [None, None, None]
+    tags = {'task': reuse_request_task.name}
+    assert sink.get('pcelery.task.reused_request', **tags).total == 2
+    assert sink.get('pcelery.task.deserialize_request', **tags).count == 1
+
+    # Message from other HTTP request
+    pyramid_request.environ['HTTP_X_CUSTOM'] = 'other'
+    reuse_request_task.delay('4')
+    tasks_queue.run_all_tasks()
+    assert requests[-1][0] != requests[0][0]
+
+
+@task(bind=True, reuse_pyramid_request=True)
+def registry_check_task(self):
+    request = self.pyramid_request
+    request.registry.registry_checks.append(request.registry is self.pyramid_registry)
+
+
+def test_reuse_pyramid_request_of_other_registry():
+    checks = []
+    for _ in range(2):
+        request = Request.blank('http://localhost')
+        with testing.testConfig(request=request) as config:
+            config.include('pcelery')
+            config.set_celery_config({'testing': True})
+            config.scan()
+            config.commit()
+            registry = config.registry
+            registry.registry_checks = checks
+            request.registry = registry
+            tasks_queue = TasksQueue(registry)
+            registry_check_task.delay()
+            tasks_queue.run_all_tasks()
+    assert checks == [True, True]
+
+
+@task(bind=True, reuse_pyramid_request=True)
+def reuse_callbacks_task(self, value):
+    request = self.pyramid_request
+    calls = request.registry.callback_calls
+    calls.append((value, list(request.task_state.values)))
+    request.task_state.values.append(value)
+    request.add_finished_callback(lambda r: calls.append(('finished', value)))
+
+
+def _callbacks_root_factory(request):
+    calls = request.registry.callback_calls
+    request.add_finished_callback(lambda r: calls.append(('finished', 'root')))
+    assert request.task_state.values == []
+    return DefaultRootFactory(request)
+
+
+def test_reuse_pyramid_request_state():
+    request = Request.blank('http://localhost')
+    with testing.testConfig(request=request) as config:
+        config.include('pcelery')
+        config.set_celery_config({'testing': True})
+        config.set_root_factory(_callbacks_root_factory)
+        config.add_request_method(
+            lambda r: SimpleNamespace(values=[]), 'task_state', reify=True
+        )
+        config.scan()
+        config.commit()
+        registry = config.registry
+        registry.callback_calls = calls = []
+        request.registry = registry
+        tasks_queue = TasksQueue(registry)
+        reuse_callbacks_task.delay(1)
+        reuse_callbacks_task.delay(2)
+        tasks_queue.run_all_tasks()
+    # Callback added by the first task does not fire in the second one,
+    # and reified values are computed again.
+    assert calls == [
+        (1, []),
+        ('finished', 'root'),
+        ('finished', 1),
+        (2, []),
+        ('finished', 'root'),
+        ('finished', 2),
+    ]
@@ -1,13 +1,38 @@
 """Get Celery instance from Pyramid configuration."""
 
+from collections.abc import Awaitable, Callable, Iterable
 from copy import deepcopy
+from functools import partial
+from typing import Optional
 
 from celery import Celery, Task
 from kombu import Exchange, Queue
+from pyramid.config import Configurator
 from pyramid.registry import Registry
+from pyramid.threadlocal import get_current_request
 
-from .base_task import PyramidCeleryTask
+from .base_task import (
+    ENV_FILTER_KEY,
+    REQUEST_PROPAGATION_KEY,
+    PyramidCeleryTask,
+    RequestEnvFilter,
+)
+from .batches import get_batch_task_class
 from .interfaces import ICeleryQueuesFactory
+from .publisher import ASYNC_PUBLISH_QUEUE_SIZE_KEY, get_async_publisher
+from .task_registry import LazyTaskRegistry
+
+
+TASK_PROXIES_KEY = 'pcelery_task_proxies'
+WARMUP_KEY = 'pcelery_warmup'
+ROUTING_CONFIG_KEYS = (
+    'task_queues',
+    'task_routes',
+    'task_default_exchange',
+    'task_default_exchange_type',
+    'task_default_queue',
+    'task_default_routing_key',
+)
 
 
 def _get_celery_config(registry: Registry) -> dict:
@@ -17,9 +42,18 @@ def _get_celery_config(registry: Registry) -> dict:
 
     is_testing = celery_config.pop('testing', False)
     if is_testing:
+        # Keep queues and routes from configuration instead of the one queue
+        keep_queues = celery_config.get('keep_queues', False)
+        original_config = celery_config
         celery_config = {
             'app_name': celery_config.get('app_name'),
             'task_cls': celery_config.get('task_cls'),
+            'request_env': celery_config.get('request_env'),
+            'outbox_only_on_success': celery_config.get('outbox_only_on_success'),
+            'outbox_async': celery_config.get('outbox_async'),
+            'warmup': celery_config.get('warmup'),
+            'lazy_tasks': celery_config.get('lazy_tasks'),
+            'async_publish_queue_size': celery_config.get('async_publish_queue_size'),
             'beat_schedule': celery_config.get('beat_schedule'),
             'broker_url': 'memory://',
             'accept_content': ['json', 'msgpack', 'yaml'],
@@ -51,18 +85,28 @@ def _get_celery_config(registry: Registry) -> dict:
                 ),
             ],
         }
+        if keep_queues:
+            for key in ROUTING_CONFIG_KEYS:
+                celery_config.pop(key, None)
+                if key in original_config:
+                    celery_config[key] = original_config[key]
+            _add_factories_queues(registry, celery_config)
     else:
-        celery_queues = []
-        # Add queues created by other applications
-        for _, queues_factory in registry.getUtilitiesFor(ICeleryQueuesFactory):
-            celery_queues += queues_factory(registry)
-
-        task_queues = celery_config.setdefault('task_queues', [])
-        task_queues.extend(celery_queues)
+        _add_factories_queues(registry, celery_config)
 
     return celery_config
 
 
+def _add_factories_queues(registry: Registry, celery_config: dict):
+    celery_queues = []
+    # Add queues created by other applications
+    for _, queues_factory in registry.getUtilitiesFor(ICeleryQueuesFactory):
+        celery_queues += queues_factory(registry)
+
+    task_queues = celery_config.setdefault('task_queues', [])
+    task_queues.extend(celery_queues)
+
+
 def get_celery(registry) -> Celery:
     """Load and configure Celery app.
 
@@ -75,18 +119,199 @@ def get_celery(registry) -> Celery:
         config = _get_celery_config(registry)
         app_name = config.pop('app_name', None) or 'pcelery'
         task_cls = config.pop('task_cls', None) or PyramidCeleryTask
+        lazy_tasks = config.pop('lazy_tasks', False)
+        request_env = config.pop('request_env', None)
+        if request_env is not None:
+            if not isinstance(request_env, RequestEnvFilter):
+                request_env = RequestEnvFilter(**request_env)
+            registry[ENV_FILTER_KEY] = request_env
+        registry['pcelery_outbox_only_on_success'] = bool(
+            config.pop('outbox_only_on_success', False)
+        )
+        registry['pcelery_outbox_async'] = bool(config.pop('outbox_async', False))
+        registry[ASYNC_PUBLISH_QUEUE_SIZE_KEY] = config.pop(
+            'async_publish_queue_size', None
+        )
         celery = registry.celery = Celery(
             app_name,
             task_cls=task_cls,
             loader='pcelery.loader:PyramidCeleryLoader',
+            tasks=LazyTaskRegistry() if lazy_tasks else None,
         )
+        warmup = config.pop('warmup', None)
         celery.config_from_object(config)
         # Expose Pyramid registry to Celery app and tasks
         celery.pyramid_registry = registry
+        if warmup:
+            if not isinstance(warmup, dict):
+                warmup = {'connections': int(warmup)}
+            warmup = dict(warmup)
+            after_fork = warmup.pop('after_fork', False)
+            registry[WARMUP_KEY] = warmup
+            if not after_fork:
+                warm_up_celery(celery, **warmup)
 
     return celery
 
 
+def warm_up_celery(celery: Celery, connections=1, declare_queues=True):
+    """Pre-establish pooled broker connections and producers.
+
+    :param celery: Celery app
+    :param connections: number of connections and producers that will be
+        created in pools of Celery app (it is limited by ``broker_pool_limit``)
+    :param declare_queues: declare all queues from ``task_queues`` setting
+        (including queues created by ``ICeleryQueuesFactory`` utilities)
+    """
+    limit = celery.pool.limit
+    if limit:
+        connections = min(connections, limit)
+    producers = []
+    try:
+        for _ in range(connections):
+            producer = celery.producer_pool.acquire(block=True)
+            producers.append(producer)
+            producer.connection.ensure_connection()
+        if declare_queues and producers:
+            channel = producers[0].channel
+            for queue in celery.amqp.queues.values():
+                queue(channel).declare()
+    finally:
+        for producer in producers:
+            producer.release()
+
+
+def warm_up_after_fork(registry: Registry):
+    """Warm up pools of Celery app in a child process of web server
+    with parameters from key ``warmup`` of celery configuration.
+
+    Call it from post-fork hook of the server, e.g. in ``gunicorn.conf.py``:
+
+        .. code-block:: python
+
+            def post_fork(server, worker):
+                warm_up_after_fork(worker.app.wsgi().registry)
+
+    Parent process must not use the pools before fork, so set
+    ``after_fork`` in the key ``warmup`` to skip warming up during
+    creation of Celery app.
+    """
+    warmup = registry.get(WARMUP_KEY)
+    if warmup is not None:
+        warm_up_celery(get_celery(registry), **warmup)
+
+
+def add_task_action(config: Configurator, name: str, proxy: 'TaskProxy'):
+    """Add configuration action that creates Celery task for the given proxy."""
+
+    def register():
+        register_task(config.registry, proxy)
+
+    config.action('bind_celery_task - %s' % name, register)
+
+
+def register_task(registry: Registry, proxy: 'TaskProxy'):
+    """Create Celery task for the given proxy and bind it to the proxy.
+
+    If Celery app uses ``LazyTaskRegistry`` (``lazy_tasks`` option),
+    the task is only added as pending and will be created on first access.
+    """
+    celery = get_celery(registry)
+    tasks = celery.tasks
+    if isinstance(tasks, LazyTaskRegistry):
+        func = proxy.original_func
+        name = proxy.task_options.get('name') or celery.gen_task_name(
+            func.__name__, func.__module__
+        )
+        # Alternative names are known before creation of the task,
+        # so propagation of request is set up for all names of the task.
+        alt_names = _get_alt_names(registry, _get_pending_task(celery, proxy, name))
+        propagation = registry.setdefault(REQUEST_PROPAGATION_KEY, {})
+        for task_name in [name, *alt_names]:
+            propagation[task_name] = proxy.propagate_request
+        tasks.add_pending(
+            name, partial(_create_task, registry, celery, proxy, alt_names)
+        )
+        proxy.bind_task_loader(name, partial(tasks.materialize, name))
+    else:
+        name = _create_task(registry, celery, proxy)
+    registry.setdefault(TASK_PROXIES_KEY, {})[name] = proxy
+
+
+def rebind_task_proxies(registry: Registry):
+    """Bind proxies of tasks registered in the registry to its Celery app.
+
+    Proxies are module-level objects, so configuring of other registry
+    rebinds them to Celery app of that registry.
+    """
+    celery = get_celery(registry)
+    tasks = celery.tasks
+    lazy = isinstance(tasks, LazyTaskRegistry)
+    for name, proxy in registry.get(TASK_PROXIES_KEY, {}).items():
+        celery_task = proxy.celery_task
+        if celery_task is not None and celery_task.app is celery:
+            continue
+        if lazy and name not in tasks:
+            proxy.bind_task_loader(name, partial(tasks.materialize, name))
+        else:
+            proxy.bind_celery_task(tasks[name])
+
+
+def _get_task_options(celery: Celery, proxy: 'TaskProxy') -> dict:
+    options = proxy.task_options
+    if options.get('batch_size'):
+        base = options.get('base') or celery.Task
+        options = dict(options, base=get_batch_task_class(celery, base))
+    return options
+
+
+def _get_pending_task(celery: Celery, proxy: 'TaskProxy', name: str) -> Task:
+    """Returns instance of the task class of a pending task for factories
+    of alternative names. The task is neither registered nor bound to
+    Celery app."""
+    options = dict(_get_task_options(celery, proxy))
+    base = options.pop('base', None) or celery.Task
+    func = proxy.original_func
+    run = func if options.pop('bind', False) else staticmethod(func)
+    attrs = {
+        'name': name,
+        'run': run,
+        '__doc__': func.__doc__,
+        '__module__': func.__module__,
+        **options,
+    }
+    return type(func.__name__, (base,), attrs)()
+
+
+def _get_alt_names(registry: Registry, celery_task: Task) -> list[str]:
+    alt_names = []
+    for alt_name_factory in registry.get('pcelery_alt_name_factories', None) or ():
+        if alt_name := alt_name_factory(celery_task):
+            alt_names.append(alt_name)
+    return alt_names
+
+
+def _create_task(
+    registry: Registry,
+    celery: Celery,
+    proxy: 'TaskProxy',
+    alt_names: Optional[list[str]] = None,
+):
+    options = _get_task_options(celery, proxy)
+    celery_task = celery.task(proxy.original_func, **options)
+    if alt_names is None:
+        alt_names = _get_alt_names(registry, celery_task)
+    task_names = [celery_task.name]
+    for alt_name in alt_names:
+        celery.tasks[alt_name] = celery_task
+        task_names.append(alt_name)
+    propagation = registry.setdefault(REQUEST_PROPAGATION_KEY, {})
+    for task_name in task_names:
+        propagation[task_name] = proxy.propagate_request
+    proxy.bind_celery_task(celery_task)
+    return celery_task.name
+
+
 class TaskProxy:
     """Late-bind Celery tasks to decorated functions.
 
@@ -97,10 +322,20 @@ class TaskProxy:
     the calls to Celery Task object after it has been bound during the end of configuration.
     """
 
-    def __init__(self, original_func):
+    #: Attributes of Celery task that are bound directly to the proxy
+    #: (as well as ``name``). Other attributes are resolved through
+    #: ``__getattr__()``, that is about 15 times slower than access to
+    #: the attribute of Celery task, so use ``proxy.celery_task`` to read
+    #: them in hot loops.
+    fast_attributes = ('delay', 'apply_async', 's', 'si', 'signature')
+
+    def __init__(self, original_func, task_options=None, propagate_request=True):
         name = original_func.__module__ + '.' + original_func.__name__
         self.original_func = original_func
+        self.task_options = task_options or {}
+        self.propagate_request = propagate_request
         self.celery_task = None
+        self._task_loader = None
         self.name = name
 
         # Venusian setup
@@ -114,31 +349,107 @@ class TaskProxy:
         return self.__str__()
 
     def __call__(self, *args, **kwargs):
-        if not self.celery_task:
+        celery_task = self.celery_task
+        if celery_task is None:
+            celery_task = self._get_celery_task('__call__')
+        return celery_task(*args, **kwargs)
+
+    def _get_celery_task(self, item: str) -> Task:
+        if self.celery_task is None and self._task_loader is not None:
+            # Create the lazy task
+            self._task_loader()
+        if self.celery_task is None:
             raise RuntimeError(
                 'Celery task creation failed. Did config.scan() do '
-                f'a sweep on {self.original_func}? TaskProxy tried '
-                'to look up attribute: __call__'
+                f'a sweep on {self.name}? TaskProxy tried '
+                f'to look up attribute: {item}'
             )
-        return self.celery_task(*args, **kwargs)
+        return self.celery_task
+
+    def delay_many(self, iterable_of_args, **options) -> list:
+        """Publish a message of the task for each item of ``iterable_of_args``.
+
+        All messages are published through one producer acquired from
+        the pool of Celery app. Every item is a tuple of positional
+        arguments of the task; ``options`` are passed to ``apply_async()``.
+
+        Returns list of ``AsyncResult``.
+        """
+        celery_task = self._get_celery_task('delay_many')
+        calls = ((celery_task, args, None, options) for args in iterable_of_args)
+        return apply_many(celery_task.app, calls)
+
+    def delay_after_response(self, *args, **kwargs) -> bool:
+        """Add the task into outbox of current Pyramid request.
+
+        The task will be published at the end of the request, duplicates
+        are published only once. Task is published immediately if there is
+        no current request.
+
+        Returns ``False`` if the same task already exists in the outbox.
+        """
+        celery_task = self._get_celery_task('delay_after_response')
+        request = get_current_request()
+        if request is None:
+            celery_task.delay(*args, **kwargs)
+            return True
+        return request.pcelery_outbox.add(celery_task, args, kwargs)
+
+    def delay_async(self, *args, **kwargs) -> Awaitable:
+        """Asyncio version of ``delay()``.
+
+        The message is published by a dedicated thread, so the event loop
+        is not blocked by I/O of the broker. The current request is captured
+        during the call; await the result to get ``AsyncResult``.
+        """
+        return self.apply_async_async(args, kwargs)
+
+    def apply_async_async(self, args=None, kwargs=None, **options) -> Awaitable:
+        """Asyncio version of ``apply_async()``."""
+        celery_task = self._get_celery_task('apply_async_async')
+        publisher = get_async_publisher(celery_task.app.pyramid_registry)
+        return publisher.apply_async(celery_task, args, kwargs, **options)
+
+    def bind_task_loader(self, name: str, loader: Callable[[], None]):
+        """Set callable that creates and binds Celery task on first access
+        to the proxy.
+
+        :param name: name of Celery task that will be created by the loader.
+        """
+        self.celery_task = None
+        self.name = name
+        for item in self.fast_attributes:
+            self.__dict__.pop(item, None)
+        self._task_loader = loader
 
     def bind_celery_task(self, celery_task):
         assert isinstance(celery_task, Task)
         self.celery_task = celery_task
-        if 'name' in self.__dict__:
-            del self.__dict__['name']
+        self._task_loader = None
+        # Bind frequently used attributes directly to the proxy
+        # to avoid calling of __getattr__().
+        self.name = celery_task.name
+        for item in self.fast_attributes:
+            setattr(self, item, getattr(celery_task, item))
 
     def __getattr__(self, item):
         """Resolve all method calls to the underlying task."""
 
-        if item == '__wrapped__':
+        if item in ('__wrapped__', 'celery_task', '_task_loader'):
             raise AttributeError(item)
 
-        if not self.celery_task:
-            raise RuntimeError(
-                'Celery task creation failed. Did config.scan() do '
-                f'a sweep on {self.name}? TaskProxy tried '
-                f'to look up attribute: {item}'
-            )
+        return getattr(self._get_celery_task(item), item)
+
 
-        return getattr(self.celery_task, item)
+def apply_many(celery: Celery, calls: Iterable[tuple]) -> list:
+    """Publish many messages through one producer.
+
+    :param celery: Celery app
+    :param calls: iterable of tuples ``(task, args, kwargs, options)``
+    :return: list of ``AsyncResult``
+    """
+    with celery.producer_or_acquire() as producer:
+        return [
+            task.apply_async(args, kwargs, producer=producer, **(options or {}))
+            for task, args, kwargs, options in calls
+        ]
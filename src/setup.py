@@ -92,6 +92,8 @@ setup(
         ],
         'console_scripts': [
             'pcelery = pcelery.commands:pcelery',
+            'pcelery_manifest = pcelery.commands:pcelery_manifest',
+            'pcelery_benchmark = pcelery.benchmarks:main',
             'pcelery_test = pcelery.runtests:runtests [test]',
         ],
     },